@@ -1 +1,9 @@
-from .core import *
+# NOTE: QSAM is imported lazily so that worker processes can import the
+# QGIS-free modules of this package (e.g. `dataset`) without pulling in QGIS
+
+def __getattr__(name):
+    if name == "QSAM":
+        from .core import QSAM
+        return QSAM
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -4,3 +4,6 @@ PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 #
 MODE_DEBUG = False
+
+# SAM embeddings cache, least recently used embeddings are deleted beyond it
+EMBEDDING_CACHE_MAX_MB = 2048
@@ -5,7 +5,7 @@ from qgis.gui import *
 
 import processing
 
-from PyQt5.QtWidgets import QInputDialog, QMessageBox
+from PyQt5.QtWidgets import QInputDialog
 from PyQt5.QtGui import QColor
 from PyQt5.QtCore import Qt, QVariant
 
@@ -23,6 +23,8 @@ from . import (
     sam,
     tasks,
     consts,
+    writer,
+    overlap,
     data, )
 
 __all__ = ["QSAM"]
@@ -50,18 +52,40 @@ class QSAM:
         image_context: utils.ImageContext = utils.image_from_layer(
             layer=layer, bbox=bbox, resolution=self.__sam_resolution)
 
-        self.datastore.insert_roi(bbox)
+        cache_key = utils.embedding_key(
+            layer=layer,
+            bbox=bbox,
+            resolution=self.__sam_resolution,
+            checkpoint=self.sam.checkpoint)
+
+        self.roi_id = self.datastore.insert_roi(
+            bbox,
+            layer=layer,
+            resolution=self.__sam_resolution,
+            checkpoint=self.sam.checkpoint)
+
+        if consts.MODE_DEBUG:
+            utils.log("ROIs store", self.datastore.stats())
+
+        # the key is only recorded once its embedding is cached
+        roi_id, checkpoint = self.roi_id, self.sam.checkpoint
+
+        def on_embedded(key: str):
+            self.datastore.set_embedding_key(roi_id, key, checkpoint=checkpoint)
 
         # return
 
         if consts.MODE_DEBUG:
-            self.sam.set_image(image_context=image_context)
+            self.sam.set_image(image_context=image_context, cache_key=cache_key)
+            on_embedded(cache_key)
 
         else:
             task = tasks.SamImageEmbedTask(
                 sam=self.sam,
                 context=image_context,
-                description="QSAM Image Embed")
+                cache_key=cache_key,
+                description="QSAM Image Embed",
+                callback=on_embedded)
 
             task_id = QgsApplication.instance().taskManager().addTask(task=task,)
 
@@ -99,12 +123,11 @@ class QSAM:
 
         parameters = {
             "DB_FILE": db_file,
-            "INPUT_RASTER": selected_raster.id(),
+            "INPUT_RASTERS": [selected_raster.id()],
             "INPUT_VECTOR": selected_vector.id(),
             "OUTPUT_DIR": utils.get_dataset_write_path(),
         }
 
-        self.datastore.backup(db_file)
         processing.execAlgorithmDialog("qsam:export_dataset", parameters)
 
     def __modeling_processing_alg(self):
@@ -204,23 +227,17 @@ class QSAM:
     def _sam_stream(self, pts: list[list[QgsReferencedPointXY, int]]):
 
         if not self.__stream_points or not self.__sam_initial_check():
-            self._rb_mask.reset()
-            self.canvas.refresh()
-
+            self._preview.reset()
             return
 
-        shapes = self.sam.qgs_prompt_points(pts, to_crs="proj")
+        mask, transform = self.sam.qgs_prompt_points_mask(pts, to_crs="proj")
 
-        for geom in shapes:
-            self._rb_mask.setToGeometry(geom)
-            self._rb_mask.setColor(QColor(0, 0, 0, 100))
-            self._rb_mask.setWidth(2)
+        if mask is None:
+            return self._preview.reset()
 
-        self.canvas.refresh()
+        self._preview.set_mask(mask, transform)
 
     def _sam_prompt(self, pts: list[list[QgsReferencedPointXY, int]]):
-        # TODO: Fix window refresh bug, (right mouse click after saving should reset it)
-
         if not self.__sam_initial_check():
             return
 
@@ -247,6 +264,9 @@ class QSAM:
                 level=Qgis.MessageLevel.Warning,
                 duration=2)
 
+        shapes, counts = self.resolver.resolve(layer, shapes, class_id)
+        self.__overlap_notice(counts)
+
         features = []
         for geom in shapes:
             ft = QgsFeature()
@@ -256,13 +276,10 @@ class QSAM:
             features.append(ft)
 
         # write to vector file
-        if utils.write_features_into_vector_layer(
-            features=features,
-            layer=layer,
-            canvas=self.canvas
-        ):
-            self.toolbar.ptool.activate()
-            self.canvas.refresh()
+        self.resolver.add(layer, features, class_id)
+        self.writer.add(layer, features)
+
+        self.toolbar.ptool.activate()
 
     def _sam_stream_box(self, bbox: QgsReferencedRectangle):
         """Stream bbox prompts
@@ -271,21 +288,17 @@ class QSAM:
         if not self.__sam_initial_check():
             return
 
-        shapes = self.sam.qgs_prompt_bbox(bbox, to_crs="proj")
+        mask, transform = self.sam.qgs_prompt_bbox_mask(bbox, to_crs="proj")
 
-        for geom in shapes:
-            self._rb_mask.setToGeometry(geom)
-            self._rb_mask.setColor(QColor(0, 0, 0, 100))
-            self._rb_mask.setWidth(2)
+        if mask is None:
+            return self._preview.reset()
 
-        self.canvas.refresh()
+        self._preview.set_mask(mask, transform)
 
     def _sam_prompt_box(self, bbox: QgsReferencedRectangle):
         """Finalise bbox prompts and write into vector layer
         Accept bbox -> segment -> write into vector layer"""
 
-        # TODO: Fix window refresh bug, (right mouse click after saving should reset it)
-
         if not self.__sam_initial_check():
             return
 
@@ -301,6 +314,9 @@ class QSAM:
 
         class_id, _ = QInputDialog.getInt(None, "QSAM", "Enter the Class ID")
 
+        shapes, counts = self.resolver.resolve(layer, shapes or [], class_id)
+        self.__overlap_notice(counts)
+
         features: list[QgsFeature] = []
         for geom in shapes:
             area = geom.area()
@@ -312,34 +328,97 @@ class QSAM:
             features.append(ft)
 
         # write to vector file
-        if utils.write_features_into_vector_layer(
-            features=features,
-            layer=layer,
-            canvas=self.canvas
-        ):
-            self._rb_mask.reset()
-            self.canvas.refresh()
+        self.resolver.add(layer, features, class_id)
+        self.writer.add(layer, features)
+
+        self._preview.reset()
+
+    def __on_features_written(self, layer_id: str, features: list, written: list):
+        """Count written features as annotations of the ROI each one overlaps most"""
+
+        layer = QgsProject.instance().mapLayer(layer_id)
+
+        if layer is None or self.datastore.db is None:
+            return
+
+        counts: dict[int, int] = {}
+
+        for ft in written:
+            if not ft.hasGeometry():
+                continue
+
+            bbox = QgsReferencedRectangle(ft.geometry().boundingBox(), layer.crs())
+            extents = self.datastore.roi_extents(bbox)
+
+            if extents:
+                roi_id, _ = max(extents, key=lambda e: e[1].area())
+                counts[roi_id] = counts.get(roi_id, 0) + 1
+
+        for roi_id, count in counts.items():
+            self.datastore.add_annotations(roi_id, count)
+
+    def __overlap_notice(self, counts: dict[str, int]):
+        """Tell the user when the overlap policy dropped or reshaped new polygons"""
+
+        changes = ", ".join(f"{n} {k}" for k, n in counts.items() if n)
+
+        if not changes:
+            return
+
+        self.iface.messageBar().pushMessage(
+            text=f"Overlapping polygons ({self.resolver.policy}): {changes}",
+            level=Qgis.MessageLevel.Info,
+            duration=3)
+
+    def __load_roi_layer(self):
+        """(Re)build the ROIs overlay from the whole store"""
+
+        provider = self._roi_layer.dataProvider()
+        provider.truncate()
+        provider.addFeatures(utils.roi_features(self.datastore.list_records(), self._roi_layer))
+
+        self._roi_layer.updateExtents()
+        self._roi_layer.triggerRepaint()
+
+    def __on_rois_inserted(self, records: list):
+        if self._roi_layer is None:
+            return
+
+        self._roi_layer.dataProvider().addFeatures(utils.roi_features(records, self._roi_layer))
+
+        self._roi_layer.updateExtents()
+        self._roi_layer.triggerRepaint()
 
     def __show_rois(self, v: bool):
-        self._rb_rois.reset()
-        self.canvas.refresh()
+        if v and self._roi_layer is None:
+            self._roi_layer = utils.roi_vector_layer()
+            self._roi_layer.willBeDeleted.connect(lambda: setattr(self, "_roi_layer", None))
+            self.__load_roi_layer()
 
-        if v:
-            rts = self.datastore.list_rois()
-            if not rts:
-                return
+            QgsProject.instance().addMapLayer(self._roi_layer, False)
+            QgsProject.instance().layerTreeRoot().insertLayer(0, self._roi_layer)
 
-            geoms = []
+        if self._roi_layer is not None:
+            node = QgsProject.instance().layerTreeRoot().findLayer(self._roi_layer.id())
 
-            for rt in rts:
-                geoms.append(QgsGeometry.fromRect(rt))
+            if node is not None:
+                node.setItemVisibilityChecked(v)
 
-            self._rb_rois.setToGeometry(QgsGeometry.collectGeometry(geoms), rt.crs())
-            self._rb_rois.setColor(QColor(0, 255, 0, 255))
-            self._rb_rois.setFillColor(QColor(255, 255, 255, 0))
+    def __open_datastore(self, path: str):
+        """Switch the ROIs store to `path`, carrying the current ROIs over to new files"""
 
-            self._rb_rois.setWidth(4)
-            self.canvas.refresh()
+        if path == self.datastore.path:
+            return
+
+        if not os.path.exists(path):
+            self.datastore.save_as(path)
+        else:
+            self.datastore.open(path)
+
+        if self._roi_layer is not None:
+            self.__load_roi_layer()
+
+        utils.log("ROIs store", self.datastore.stats())
 
     def __init__(self, iface: QgisInterface):
         self.iface = iface
@@ -350,9 +429,15 @@ class QSAM:
         self.__sam_resolution = 1000
 
         self.datastore = data.DataStore()
+        self.datastore.on_insert.append(self.__on_rois_inserted)
+        self.writer = writer.FeatureWriter()
+        self.writer.flushed.connect(self.__on_features_written)
+
+        self.resolver = overlap.OverlapResolver(self.writer)
 
         # state variables
         self.bbox: QgsRectangle = None
+        self.roi_id: int = None
         self.available_rasters: list[QgsRasterLayer] = []
         self.available_vectors: list[QgsVectorLayer] = []
         self.selected_raster_index: int = -1
@@ -402,31 +487,17 @@ class QSAM:
         self.panel.widget_sam.selected_device.connect(self.sam.set_device)
         self.panel.widget_sam.selected_checkpoint.connect(self._sam_model_select)
         self.panel.widget_sam.streaming_enabled.connect(lambda v: setattr(self, "_QSAM__stream_points", v))
+        self.panel.widget_sam.cleanup_set.connect(lambda k, v: setattr(self.sam.cleanup, k, v))
+        self.panel.widget_sam.overlap_policy_set.connect(lambda v: setattr(self.resolver, "policy", v))
 
         # ------------------------------------------------
         ## DATASET
         self.panel.widget_roi.show_rois.connect(self.__show_rois)
 
-        source_db_path = self.panel.widget_roi.i_rois_db_path.text()
-
-        if os.path.exists(source_db_path):
-            reply = QMessageBox().question(
-                None,
-                "QSAM — Confirm Action",
-                "The DB file exists, do you want to load the data in?",
-                QMessageBox.Yes | QMessageBox.No,
-                QMessageBox.Yes)
-
-            if reply == QMessageBox.Yes:
-                self.datastore.load(source_db_path)
+        self.__open_datastore(self.panel.widget_roi.get_db_path())
 
         self.panel.widget_roi.export_button_clicked.connect(self.__datasets_processing_alg)
-
-        self.panel.widget_roi.i_rois_db_path.textChanged.connect(
-            lambda: (
-                self.datastore.backup(self.panel.widget_roi.i_rois_db_path.text())
-                if not os.path.exists(utils.get_db_path()) else
-                self.datastore.load(self.panel.widget_roi.i_rois_db_path.text())))
+        self.panel.widget_roi.i_rois_db_path.textChanged.connect(self.__open_datastore)
 
         # ------------------------------------------------
         # MODELING
@@ -444,8 +515,13 @@ class QSAM:
 
     def initGui(self):
         self._rb_bbox = QgsRubberBand(self.canvas, Qgis.GeometryType.Polygon)
-        self._rb_mask = QgsRubberBand(self.canvas, Qgis.GeometryType.Polygon)
-        self._rb_rois = QgsRubberBand(self.canvas, Qgis.GeometryType.Polygon)
+        self._preview = widgets.MaskPreview(self.canvas)
+
+        utils.render_counter.attach(self.canvas)
+
+        # flush pending features when switching tools
+        self.canvas.mapToolSet.connect(self.__on_map_tool_set)
+        self._roi_layer: QgsVectorLayer = None
 
         self.__setup_panel()
         self.__setup_toolbar()
@@ -465,20 +541,34 @@ class QSAM:
         self._rb_bbox.setWidth(3)
 
         self._rb_bbox.show()
-        self.canvas.refresh()
 
     def clear_canvas(self):
         self._rb_bbox.reset()
-        self._rb_mask.reset()
+        self._preview.reset()
 
-        self.canvas.refresh()
+    def __on_map_tool_set(self, *_):
+        self.writer.flush_all()
 
     def unload(self):
+        self.canvas.mapToolSet.disconnect(self.__on_map_tool_set)
+        self.writer.flush_all(background=False)
+
+        pending = sum(len(fts) for fts in self.writer.buffers.values())
+        if pending:
+            utils.log(f"Features could not be written on unload {{features: {pending}}}")
+
         # don't unload since it should persist without plugin
-        self._rb_rois.reset()
-        self.datastore.backup(self.panel.widget_roi.i_rois_db_path.text())
+        if self._roi_layer is not None:
+            QgsProject.instance().removeMapLayer(self._roi_layer.id())
+            self._roi_layer = None
+
+        self.datastore.close()
 
         self.clear_canvas()
+        self.canvas.scene().removeItem(self._preview)
+
+        utils.render_counter.detach(self.canvas)
+        utils.log("renders per interaction", utils.render_counter.renders_per_interaction)
 
         self.toolbar.deleteLater()
         self.iface.removeDockWidget(self.panel)
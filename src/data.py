@@ -1,20 +1,121 @@
 from qgis.core import (
     QgsReferencedRectangle,
     QgsRectangle,
+    QgsRasterLayer,
     QgsCoordinateReferenceSystem)
 
+from . import utils
+
+from dataclasses import dataclass
+from typing import Callable
 from pathlib import Path
+import weakref
 import sqlite3
+import time
+import os
+
+
+SCHEMA_VERSION = 1
+
+# columns added after the initial schema, for migrating older files
+ROI_COLUMNS_V1 = {
+    "raster_source": "TEXT",
+    "layer_id": "TEXT",
+    "resolution": "REAL",
+    "checkpoint": "TEXT",
+    "embedding_key": "TEXT",
+    "annotation_count": "INTEGER NOT NULL DEFAULT 0",
+}
+
+ROI_FIELDS = (
+    "id, x_min, y_min, x_max, y_max, crs_id, "
+    "raster_source, layer_id, resolution, checkpoint, embedding_key, annotation_count")
+
+SQL_INSERT_ROI = (
+    "INSERT INTO rois (x_min, y_min, x_max, y_max, crs_id, "
+        "raster_source, layer_id, resolution, checkpoint, embedding_key) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)")
+
+
+@dataclass
+class RoiRecord:
+    id: int
+    rect: QgsReferencedRectangle
+    raster_source: str = None
+    layer_id: str = None
+    resolution: float = None
+    checkpoint: str = None
+    embedding_key: str = None
+    annotation_count: int = 0
 
 
 class DataStore:
+    """ROIs database
+
+    File backed stores run in WAL mode with every insert committed (durable)
+    on a dedicated write connection; reads go through a second connection
+    and don't block on writes. Without a path the store lives in memory"""
+
+    # every store of this process, see `opened`
+    instances: "weakref.WeakSet[DataStore]" = weakref.WeakSet()
+
     def __init__(self, path: str = None):
-        if path is None:
-            path = ":memory:"
+        self.db: sqlite3.Connection = None
+        self.path: str = None
+
+        self.__crs: dict[str, QgsCoordinateReferenceSystem] = {}
+        self.last_persist: float = None
+
+        # callbacks receiving the records of newly inserted ROIs
+        self.on_insert: list[Callable[[list[RoiRecord]], None]] = []
+
+        self.open(path)
+        DataStore.instances.add(self)
+
+    @classmethod
+    def opened(cls, path: str) -> list["DataStore"]:
+        """Open stores of this process on the file at `path`"""
+
+        path = os.path.normcase(os.path.realpath(path))
+
+        return [
+            s for s in list(cls.instances)
+            if s.db is not None and not s.in_memory
+            and os.path.normcase(os.path.realpath(s.path)) == path]
+
+    @property
+    def in_memory(self) -> bool:
+        return self.path == ":memory:"
+
+    def open(self, path: str = None):
+        """(Re)open the store on `path`"""
 
-        self.db = sqlite3.connect(path)
+        if self.db is not None:
+            self.close()
+
+        self.path = path or ":memory:"
+
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
         self.cursor = self.db.cursor()
 
+        if self.in_memory:
+            self.reader = self.db
+        else:
+            self.cursor.execute("PRAGMA journal_mode=WAL;")
+            self.cursor.execute("PRAGMA synchronous=FULL;")
+
+            self.reader = sqlite3.connect(self.path, check_same_thread=False)
+
+        self.create_tables()
+
+    def close(self):
+        if self.reader is not self.db:
+            self.reader.close()
+
+        self.db.close()
+        self.db = None
+
+    def create_tables(self):
         # Create table "rois"
         self.cursor.execute("""
             CREATE TABLE IF NOT EXISTS rois (
@@ -28,53 +129,254 @@ class DataStore:
             )
         """)
 
+        self.migrate()
+        self.create_index()
         self.db.commit()
 
-    def insert_roi(self, rect: QgsReferencedRectangle):
-        x_min, y_min, x_max, y_max = (
+    def migrate(self):
+        """Bring files written by older versions up to SCHEMA_VERSION"""
+
+        version, = self.cursor.execute("PRAGMA user_version;").fetchone()
+
+        if version >= SCHEMA_VERSION:
+            return
+
+        columns = {r[1] for r in self.cursor.execute("PRAGMA table_info(rois);").fetchall()}
+
+        for name, decl in ROI_COLUMNS_V1.items():
+            if name not in columns:
+                self.cursor.execute(f"ALTER TABLE rois ADD COLUMN {name} {decl};")
+
+        self.cursor.executescript(f"""
+            CREATE INDEX IF NOT EXISTS rois_raster_source ON rois (raster_source);
+            CREATE INDEX IF NOT EXISTS rois_embedding_key ON rois (embedding_key);
+
+            PRAGMA user_version = {SCHEMA_VERSION};
+        """)
+
+    def create_index(self):
+        """R*Tree over the ROI extents, kept in sync with "rois" by triggers"""
+
+        self.cursor.executescript("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS rois_rtree USING rtree (
+                id, x_min, x_max, y_min, y_max
+            );
+
+            CREATE INDEX IF NOT EXISTS rois_crs_id ON rois (crs_id);
+
+            CREATE TRIGGER IF NOT EXISTS rois_rtree_insert AFTER INSERT ON rois BEGIN
+                INSERT INTO rois_rtree VALUES (new.id, new.x_min, new.x_max, new.y_min, new.y_max);
+            END;
+
+            CREATE TRIGGER IF NOT EXISTS rois_rtree_update AFTER UPDATE OF x_min, y_min, x_max, y_max ON rois BEGIN
+                UPDATE rois_rtree SET
+                    x_min = new.x_min, x_max = new.x_max,
+                    y_min = new.y_min, y_max = new.y_max
+                WHERE id = new.id;
+            END;
+
+            CREATE TRIGGER IF NOT EXISTS rois_rtree_delete AFTER DELETE ON rois BEGIN
+                DELETE FROM rois_rtree WHERE id = old.id;
+            END;
+
+            -- ROIs from databases created before the index
+            INSERT INTO rois_rtree
+                SELECT id, x_min, x_max, y_min, y_max FROM rois
+                WHERE id NOT IN (SELECT id FROM rois_rtree);
+        """)
+
+    def crs(self, crs_id: str) -> QgsCoordinateReferenceSystem:
+        if crs_id not in self.__crs:
+            self.__crs[crs_id] = QgsCoordinateReferenceSystem(crs_id)
+        return self.__crs[crs_id]
+
+    @staticmethod
+    def __roi_row(
+        rect: QgsReferencedRectangle,
+        layer: QgsRasterLayer = None,
+        resolution: float = None,
+        checkpoint: str = None,
+        embedding_key: str = None
+    ) -> tuple:
+        return (
             rect.xMinimum(), rect.yMinimum(),
-            rect.xMaximum(), rect.yMaximum(), )
+            rect.xMaximum(), rect.yMaximum(),
+            rect.crs().authid(),
+            layer.source() if layer is not None else None,
+            layer.id() if layer is not None else None,
+            resolution, checkpoint, embedding_key, )
 
-        crs = rect.crs()
+    def insert_roi(
+        self,
+        rect: QgsReferencedRectangle,
+        layer: QgsRasterLayer = None,
+        resolution: float = None,
+        checkpoint: str = None,
+        embedding_key: str = None
+    ) -> int:
+        time_start = time.perf_counter()
 
-        self.cursor.execute(
-            "INSERT INTO rois (x_min, y_min, x_max, y_max, crs_id) "
-                "VALUES (?, ?, ?, ?, ?)",
-            (x_min, y_min, x_max, y_max, crs.authid()))
+        with self.db:
+            self.cursor.execute(SQL_INSERT_ROI, self.__roi_row(
+                rect, layer, resolution, checkpoint, embedding_key))
 
-        self.db.commit()
+        self.last_persist = time.perf_counter() - time_start
+        roi_id = self.cursor.lastrowid
+
+        self.__notify([roi_id])
+        return roi_id
+
+    def insert_rois(
+        self,
+        rects: list[QgsReferencedRectangle],
+        layer: QgsRasterLayer = None,
+        resolution: float = None
+    ) -> list[int]:
+        """Insert ROIs in a single transaction, returns their ids"""
+
+        time_start = time.perf_counter()
+
+        with self.db:
+            last_id, = self.cursor.execute(
+                "SELECT COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'rois'), 0);").fetchone()
+            self.cursor.executemany(SQL_INSERT_ROI, (self.__roi_row(r, layer, resolution) for r in rects))
+
+            ids = list(range(last_id + 1, last_id + 1 + self.cursor.rowcount))
+
+        self.last_persist = time.perf_counter() - time_start
+
+        self.__notify(ids)
+        return ids
+
+    def notify_inserted(self, roi_ids: list[int]):
+        """Call the `on_insert` callbacks for ROIs inserted through another store on the same file"""
+
+        self.__notify(roi_ids)
+
+    def __notify(self, roi_ids: list[int]):
+        if not self.on_insert or not roi_ids:
+            return
+
+        records = self.__records("WHERE id BETWEEN ? AND ?", (min(roi_ids), max(roi_ids)))
+
+        for fn in self.on_insert:
+            fn(records)
+
+    def set_embedding_key(self, roi_id: int, embedding_key: str, checkpoint: str = None):
+        with self.db:
+            self.cursor.execute(
+                "UPDATE rois SET embedding_key = ?, checkpoint = COALESCE(?, checkpoint) WHERE id = ?",
+                (embedding_key, checkpoint, roi_id))
+
+    def add_annotations(self, roi_id: int, count: int):
+        with self.db:
+            self.cursor.execute(
+                "UPDATE rois SET annotation_count = annotation_count + ? WHERE id = ?",
+                (count, roi_id))
+
+    def __records(self, where: str = "", args: tuple = ()) -> list[RoiRecord]:
+        rp = self.reader.execute(f"SELECT {ROI_FIELDS} FROM rois {where};", args)
+
+        return [
+            RoiRecord(
+                id=id,
+                rect=QgsReferencedRectangle(
+                    rectangle=QgsRectangle(x_min, y_min, x_max, y_max),
+                    crs=self.crs(crs_id)),
+                raster_source=raster_source,
+                layer_id=layer_id,
+                resolution=resolution,
+                checkpoint=checkpoint,
+                embedding_key=embedding_key,
+                annotation_count=annotation_count)
+            for (
+                id, x_min, y_min, x_max, y_max, crs_id,
+                raster_source, layer_id, resolution, checkpoint, embedding_key, annotation_count,
+            ) in rp.fetchall()]
+
+    def list_records(self) -> list[RoiRecord]:
+        return self.__records()
+
+    def get_record(self, roi_id: int) -> RoiRecord:
+        rs = self.__records("WHERE id = ?", (roi_id, ))
+        return rs[0] if rs else None
+
+    def rois_for_raster(self, raster_source: str) -> list[RoiRecord]:
+        return self.__records("WHERE raster_source = ?", (raster_source, ))
+
+    def rois_with_embedding(self, checkpoint: str = None) -> list[RoiRecord]:
+        """ROIs whose embedding is still in the cache, it is pruned by `utils.prune_embedding_cache`"""
+
+        if checkpoint is None:
+            rs = self.__records("WHERE embedding_key IS NOT NULL")
+        else:
+            rs = self.__records("WHERE embedding_key IS NOT NULL AND checkpoint = ?", (checkpoint, ))
+        return [r for r in rs if utils.embedding_cache_file(r.embedding_key).exists()]
 
     def list_rois(self, superbox: QgsReferencedRectangle = None) -> list[QgsReferencedRectangle]:
-        self.cursor.execute(
-            "SELECT x_min, y_min, x_max, y_max, crs_id FROM rois;")
+        """ROIs, or their intersections with `superbox` (in its CRS) when given"""
+
+        return [r for _, r in self.roi_extents(superbox)]
+
+    def roi_extents(self, superbox: QgsReferencedRectangle = None) -> list[tuple[int, QgsReferencedRectangle]]:
+        """(id, extent) of the ROIs, as in `list_rois`"""
+
+        if superbox is None:
+            rp = self.reader.execute(
+                "SELECT id, x_min, y_min, x_max, y_max, crs_id FROM rois;")
+
+            return [
+                (roi_id, QgsReferencedRectangle(
+                    rectangle=QgsRectangle(x_min, y_min, x_max, y_max),
+                    crs=self.crs(crs_id)))
+                for roi_id, x_min, y_min, x_max, y_max, crs_id in rp.fetchall()]
 
-        rp = self.cursor.fetchall()
         rs = []
 
-        for x_min, y_min, x_max, y_max, crs_id in rp:
-            r = QgsRectangle(x_min, y_min, x_max, y_max)
-            c = QgsCoordinateReferenceSystem(crs_id)
+        for crs_id, in self.reader.execute("SELECT DISTINCT crs_id FROM rois;").fetchall():
+            crs = self.crs(crs_id)
 
-            rt = QgsReferencedRectangle(rectangle=r, crs=c)
+            # query in the ROIs' CRS, intersect in the superbox's
+            box = utils.coordinate_transform(superbox.crs(), crs).transformBoundingBox(superbox)
+            trf = utils.coordinate_transform(crs, superbox.crs())
 
-            if superbox is not None and superbox.intersects(rt):
-                rs.append(QgsReferencedRectangle(superbox.intersect(rt), crs=superbox.crs()))
-            elif superbox is None:
-                rs.append(rt)
+            rp = self.reader.execute(
+                "SELECT r.id, r.x_min, r.y_min, r.x_max, r.y_max FROM rois r "
+                    "JOIN rois_rtree t ON r.id = t.id "
+                    "WHERE r.crs_id = ? AND t.x_max >= ? AND t.x_min <= ? AND t.y_max >= ? AND t.y_min <= ?",
+                (crs_id, box.xMinimum(), box.xMaximum(), box.yMinimum(), box.yMaximum()))
+
+            for roi_id, x_min, y_min, x_max, y_max in rp.fetchall():
+                r = QgsRectangle(x_min, y_min, x_max, y_max)
+
+                if not trf.isShortCircuited():
+                    r = trf.transformBoundingBox(r)
+
+                if r.intersects(superbox):
+                    rs.append((roi_id, QgsReferencedRectangle(superbox.intersect(r), crs=superbox.crs())))
         return rs
 
-    def load(self, path: str):
-        """Load records from file to this classes object"""
+    def save_as(self, path: str):
+        """Copy the store to a new file at `path` and continue on it"""
+
+        target_db = sqlite3.connect(path)
 
-        source_db = sqlite3.connect(path)
+        with target_db:
+            self.db.backup(target_db)
 
-        with source_db:
-            source_db.backup(self.db)
+        target_db.close()
+        self.open(path)
 
-    def backup(self, path: str):
-        """Save records from in-memory db to backup path"""
+    def stats(self) -> dict:
+        page_count, = self.reader.execute("PRAGMA page_count;").fetchone()
+        page_size, = self.reader.execute("PRAGMA page_size;").fetchone()
+        rois, = self.reader.execute("SELECT COUNT(*) FROM rois;").fetchone()
 
-        backup_db = sqlite3.connect(path)
+        wal = f"{self.path}-wal"
 
-        with backup_db:
-            self.db.backup(backup_db)
+        return {
+            "path": self.path,
+            "rois": rois,
+            "db_size": page_count * page_size,
+            "wal_size": os.path.getsize(wal) if os.path.exists(wal) else 0,
+            "last_persist": self.last_persist, }
@@ -0,0 +1,790 @@
+# NOTE: no QGIS imports in this module, it is loaded by export / training worker processes
+
+from rasterio.windows import Window
+import rasterio.features
+import rasterio
+
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from collections import deque
+from typing import Callable, Iterable, Iterator
+from pathlib import Path
+import multiprocessing
+import numpy as np
+import threading
+import hashlib
+import struct
+import zlib
+import json
+import sys
+import os
+
+
+INDEX_FILE = "index.json"
+SHARDS_DIR = "shards"
+
+# per-sample arrays of a shard
+SHARD_ARRAYS = ("images", "labels", "histograms", "scales")
+
+# arrays zlib compressed sample by sample in compressed shards
+COMPRESSED_ARRAYS = ("images", "labels")
+
+# label of padding and nodata pixels, ignored by the segmentation loss
+IGNORE_INDEX = 255
+NUM_CLASSES = 256
+
+
+def normalize(a: np.ndarray) -> np.ndarray:
+    """Min-max scale every (H, W) plane of `a`, in shape (..., H, W), to [0, 1]
+
+    Works on a (C, H, W) window as on a stack of windows in one pass, constant
+    planes come out as zeros"""
+
+    a = a.astype(np.float32)
+
+    lo = a.min(axis=(-2, -1), keepdims=True)
+    hi = a.max(axis=(-2, -1), keepdims=True)
+
+    a -= lo
+    a /= np.where(hi > lo, hi - lo, 1)
+    return a
+
+
+class Storage:
+    float32 = "float32"     # normalized to [0, 1], as float32
+    native = "native"       # raster values in the raster's dtype
+    uint8 = "uint8"         # normalized and quantized to 8 bits
+
+    all = [float32, native, uint8]
+
+
+def encode(windows: np.ndarray, storage: str = Storage.native) -> tuple[np.ndarray, np.ndarray]:
+    """Stored values of (N, C, H, W) raster windows and their (N, C, 2) scales
+
+    `decode` maps stored values back to the per-window, per-band min-max
+    normalization of `normalize`"""
+
+    lo = windows.min(axis=(-2, -1)).astype(np.float32)
+    hi = windows.max(axis=(-2, -1)).astype(np.float32)
+
+    scales = np.zeros((*lo.shape, 2), dtype=np.float32)
+
+    if storage == Storage.native:
+        span = np.where(hi > lo, hi - lo, 1)
+
+        scales[..., 0] = 1 / span
+        scales[..., 1] = -lo / span
+        return windows, scales
+
+    windows = normalize(windows)
+
+    if storage == Storage.uint8:
+        scales[..., 0] = 1 / 255
+        return np.round(windows * 255).astype(np.uint8), scales
+
+    scales[..., 0] = 1
+    return windows, scales
+
+
+def decode(images: np.ndarray, scales: np.ndarray) -> np.ndarray:
+    """Normalized float32 images from stored ones, (C, H, W) with (C, 2) scales
+    or batched (N, C, H, W) with (N, C, 2)"""
+
+    images = images.astype(np.float32)
+
+    images *= scales[..., 0, None, None]
+    images += scales[..., 1, None, None]
+    return images
+
+
+def rasterize_labels(
+    shapes: list[tuple[dict, int]],
+    window: Window,
+    transform: rasterio.Affine
+) -> np.ndarray:
+    """Burn the class of the shapes onto the window's grid, 0 is background"""
+
+    if not shapes:
+        return np.zeros((window.height, window.width), dtype=np.uint8)
+
+    return rasterio.features.rasterize(
+        shapes=shapes,
+        out_shape=(window.height, window.width),
+        transform=transform,
+        fill=0,
+        dtype=np.uint8, )
+
+
+@dataclass
+class ExportJob:
+    """Everything a worker needs to export one ROI, picklable"""
+
+    index: int
+    raster_path: str
+    window: tuple[int, int, int, int]  # col_off, row_off, width, height
+    shapes: list[tuple[dict, int]] = field(default_factory=list)
+    window_size: int = 256
+    stride: int = 256
+    max_block: int = 256 * 2 ** 20  # bytes read at once, larger ROIs are read in strips
+    storage: str = Storage.native
+    min_labelled: float = 0.        # windows with a smaller labelled fraction are empty ...
+    keep_empty: float = .1          # ... and only this share of them is kept
+    seed: int = 0
+
+
+# raster handles of the current `raster_handles` block, per thread. Pool
+# workers keep theirs for the life of the process, see `run_jobs`
+_rasters = threading.local()
+
+
+@contextmanager
+def raster_handles() -> Iterator[dict[str, rasterio.DatasetReader]]:
+    """Scope of the handles opened by `open_raster` on this thread
+
+    Nested blocks share the outermost one's handles, which are closed on its exit"""
+
+    handles = getattr(_rasters, "handles", None)
+
+    if handles is not None:
+        yield handles
+        return
+
+    _rasters.handles = handles = {}
+    try:
+        yield handles
+    finally:
+        if getattr(_rasters, "handles", None) is handles:
+            del _rasters.handles
+
+        for rf in handles.values():
+            rf.close()
+
+
+def _init_worker():
+    _rasters.handles = {}
+
+
+def open_raster(path: str) -> rasterio.DatasetReader:
+    """Handle of `path`, opened once per `raster_handles` block"""
+
+    handles = getattr(_rasters, "handles", None)
+
+    if handles is None:
+        raise RuntimeError("open_raster called outside of a raster_handles block")
+
+    if path not in handles:
+        handles[path] = rasterio.open(path)
+    return handles[path]
+
+
+def strips(
+    height: int,
+    row_bytes: int,
+    window_size: int,
+    stride: int,
+    max_bytes: int
+) -> Iterator[tuple[int, int, list[int]]]:
+    """(start, stop, window row origins) of the row strips covering `height` rows
+
+    A strip holds whole windows and at most `max_bytes`, unless a single row of
+    windows is larger"""
+
+    rows = max(window_size, max_bytes // max(row_bytes, 1))
+    origins = list(range(0, height, stride))
+
+    i = 0
+    while i < len(origins):
+        start, group = origins[i], []
+
+        while i < len(origins) and origins[i] + window_size - start <= rows:
+            group.append(origins[i])
+            i += 1
+
+        yield start, min(group[-1] + window_size, height), group
+
+
+def tile(
+    block: np.ndarray,
+    label: np.ndarray,
+    rows: list[int],
+    window_size: int,
+    stride: int,
+    storage: str = Storage.native
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Windows of a (C, H, W) block and its label, row-major, as (N, C, S, S)
+    images, (N, S, S) labels and (N, C, 2) scales
+
+    Every window is encoded on its own pixels, in one pass per window shape,
+    edge windows are padded with 0 and `IGNORE_INDEX`"""
+
+    views = [
+        (block[:, r:r + window_size, c:c + window_size], label[r:r + window_size, c:c + window_size])
+        for r in rows
+        for c in range(0, block.shape[2], stride)]
+
+    images, scales = None, None
+    labels = np.full((len(views), window_size, window_size), IGNORE_INDEX, dtype=np.uint8)
+
+    groups: dict[tuple, list[int]] = {}
+    for i, (image, _) in enumerate(views):
+        groups.setdefault(image.shape, []).append(i)
+
+    for (_, h, w), idx in groups.items():
+        stored, group_scales = encode(np.stack([views[i][0] for i in idx]), storage)
+
+        if images is None:
+            images = np.zeros((len(views), block.shape[0], window_size, window_size), dtype=stored.dtype)
+            scales = np.zeros((len(views), block.shape[0], 2), dtype=np.float32)
+
+        images[idx, :, :h, :w] = stored
+        scales[idx] = group_scales
+
+        for i in idx:
+            labels[i, :h, :w] = views[i][1]
+
+    if images is None:
+        images = np.zeros((0, block.shape[0], window_size, window_size), dtype=block.dtype)
+        scales = np.zeros((0, block.shape[0], 2), dtype=np.float32)
+    return images, labels, scales
+
+
+def histograms(labels: np.ndarray) -> np.ndarray:
+    """Class pixel counts of (N, H, W) labels, in shape (N, NUM_CLASSES)"""
+
+    n = len(labels)
+    keys = labels.reshape(n, -1).astype(np.int64) + np.arange(n)[:, None] * NUM_CLASSES
+
+    return np.bincount(keys.ravel(), minlength=n * NUM_CLASSES) \
+        .reshape(n, NUM_CLASSES).astype(np.uint32)
+
+
+def select_windows(hists: np.ndarray, min_labelled: float, keep_empty: float, rng: np.random.Generator) -> np.ndarray:
+    """Indexes of the windows to keep, given their class histograms
+
+    Windows without valid pixels are dropped, windows without labelled pixels
+    or below `min_labelled` of their valid (not ignored) pixels are kept with
+    probability `keep_empty`"""
+
+    valid = hists.sum(axis=1) - hists[:, IGNORE_INDEX]
+    labelled = valid - hists[:, 0]
+
+    empty = (labelled == 0) | (labelled < min_labelled * valid)
+    keep = (valid > 0) & (~empty | (rng.random(len(hists)) < keep_empty))
+
+    return np.flatnonzero(keep)
+
+
+def export_roi(job: ExportJob) -> dict[str, np.ndarray]:
+    """Read, label-burn and tile one ROI into samples, the stacked `SHARD_ARRAYS`
+
+    Pixels are read once, by strips of at most `job.max_block` bytes"""
+
+    with raster_handles():
+        return _export_roi(job, open_raster(job.raster_path))
+
+
+def _export_roi(job: ExportJob, rf: rasterio.DatasetReader) -> dict[str, np.ndarray]:
+    roi_window = Window(*job.window)
+    rng = np.random.default_rng(job.seed)
+
+    row_bytes = roi_window.width * rf.count * np.dtype(rf.dtypes[0]).itemsize
+
+    rs = {k: [] for k in SHARD_ARRAYS}
+    for start, stop, rows in strips(roi_window.height, row_bytes, job.window_size, job.stride, job.max_block):
+        sw = Window(roi_window.col_off, roi_window.row_off + start, roi_window.width, stop - start)
+
+        block = rf.read(window=sw)
+        label = rasterize_labels(job.shapes, sw, rf.window_transform(sw))
+
+        if rf.nodata is not None:
+            label[(block == rf.nodata).all(axis=0)] = IGNORE_INDEX
+
+        images, labels, scales = tile(
+            block, label, [r - start for r in rows], job.window_size, job.stride, job.storage)
+        hists = histograms(labels)
+
+        keep = select_windows(hists, job.min_labelled, job.keep_empty, rng)
+
+        rs["images"].append(images[keep])
+        rs["labels"].append(labels[keep])
+        rs["histograms"].append(hists[keep])
+        rs["scales"].append(scales[keep])
+
+    if not rs["images"]:
+        return {}
+    return {k: np.concatenate(v) for k, v in rs.items()}
+
+
+def python_executable() -> str:
+    """Python interpreter for worker processes, `sys.executable` may be QGIS itself"""
+
+    if os.path.basename(sys.executable).lower().startswith("python"):
+        return sys.executable
+
+    for d in (os.path.join(sys.exec_prefix, "bin"), sys.exec_prefix):
+        for name in ("python3", "python", "python.exe"):
+            path = os.path.join(d, name)
+
+            if os.path.isfile(path):
+                return path
+    return sys.executable
+
+
+def mp_context():
+    ctx = multiprocessing.get_context("spawn")
+    ctx.set_executable(python_executable())
+
+    return ctx
+
+
+def run_jobs(
+    fn: Callable,
+    jobs: Iterable,
+    workers: int = 1,
+    is_canceled: Callable[[], bool] = lambda: False
+) -> Iterator:
+    """Results of `fn` over `jobs` in job order, computed by `workers` processes
+
+    At most 2 jobs per worker are in flight, so results don't pile up in memory.
+    Raster handles are kept by the worker processes, in-process they are closed
+    once the jobs are done (or the generator closed)"""
+
+    if workers <= 1:
+        with raster_handles():
+            for job in jobs:
+                if is_canceled():
+                    return
+                yield fn(job)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context(), initializer=_init_worker) as pool:
+        pending = deque()
+        jobs = iter(jobs)
+
+        try:
+            for job in jobs:
+                pending.append(pool.submit(fn, job))
+
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+
+                if is_canceled():
+                    return
+
+            while pending:
+                yield pending.popleft().result()
+
+                if is_canceled():
+                    return
+        finally:
+            for f in pending:
+                f.cancel()
+
+
+def digest(obj) -> str:
+    """Stable hash of a JSON serializable object"""
+
+    return hashlib.sha1(json.dumps(obj, sort_keys=True).encode()).hexdigest()
+
+
+def load_index(root: Path) -> dict:
+    path = Path(root) / INDEX_FILE
+
+    if not path.exists():
+        return {}
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def segments(locations: list[tuple[int, int]]) -> list[list[int]]:
+    """Runs of consecutive (shard id, offset) locations as [shard id, start, stop]"""
+
+    rs = []
+    for shard_id, offset in locations:
+        if rs and rs[-1][0] == shard_id and rs[-1][2] == offset:
+            rs[-1][2] += 1
+        else:
+            rs.append([shard_id, offset, offset + 1])
+    return rs
+
+
+def sample_weights(hists: np.ndarray, mode: str = "balanced") -> np.ndarray:
+    """Sampling weights of windows from their class histograms, (N, NUM_CLASSES)
+
+    "frequency" weighs a window by its pixels' inverse class frequencies,
+    "balanced" gives every class present the same share of draws, spread
+    evenly over the windows containing it"""
+
+    hists = hists.astype(np.float64)
+    hists[:, IGNORE_INDEX] = 0
+
+    if mode == "frequency":
+        pixels = hists.sum(axis=0)
+        inverse = np.divide(1, pixels, out=np.zeros_like(pixels), where=pixels > 0)
+
+        totals = hists.sum(axis=1, keepdims=True)
+        weights = (hists / np.where(totals > 0, totals, 1)) @ inverse
+
+    else:
+        present = hists > 0
+        windows = present.sum(axis=0)
+
+        inverse = np.divide(1, windows, out=np.zeros(windows.shape), where=windows > 0)
+        weights = present @ inverse / max(np.count_nonzero(windows), 1)
+
+    total = weights.sum()
+    return weights / total if total > 0 else np.full(len(hists), 1 / max(len(hists), 1))
+
+
+class NpyAppender:
+    """.npy file written one sample at a time, with a header sized for `capacity`
+    samples that is rewritten with the final count on close"""
+
+    def __init__(self, path: Path, sample_shape: tuple, dtype: np.dtype, capacity: int):
+        self.path = Path(path)
+        self.sample_shape = tuple(sample_shape)
+        self.dtype = np.dtype(dtype)
+        self.count = 0
+
+        self.__file = open(self.path, "wb")
+        self.__header_len = None
+
+        self.__write_header(capacity)
+
+    def __write_header(self, count: int):
+        header = repr({
+            "descr": np.lib.format.dtype_to_descr(self.dtype),
+            "fortran_order": False,
+            "shape": (count, *self.sample_shape), })
+
+        if self.__header_len is None:
+            # aligned to 64 bytes, as numpy writes them
+            self.__header_len = -(-(10 + len(header) + 1) // 64) * 64 - 10
+
+        header = header.ljust(self.__header_len - 1) + "\n"
+
+        self.__file.seek(0)
+        self.__file.write(np.lib.format.magic(1, 0))
+        self.__file.write(struct.pack("<H", self.__header_len))
+        self.__file.write(header.encode("latin1"))
+
+    def append(self, a: np.ndarray):
+        self.__file.write(np.ascontiguousarray(a, dtype=self.dtype).tobytes())
+        self.count += 1
+
+    def close(self):
+        self.__write_header(self.count)
+        self.__file.close()
+
+
+class ChunkAppender:
+    """Samples zlib compressed one by one into a single file, with their
+    offsets saved next to it on close"""
+
+    def __init__(self, path: Path, sample_shape: tuple, dtype: np.dtype, level: int = 1):
+        self.path = Path(path)
+        self.offsets_path = self.path.with_suffix(".offsets.npy")
+
+        self.sample_shape = tuple(sample_shape)
+        self.dtype = np.dtype(dtype)
+        self.level = level
+        self.count = 0
+
+        self.__file = open(self.path, "wb")
+        self.__offsets = [0]
+
+    def append(self, a: np.ndarray):
+        chunk = zlib.compress(np.ascontiguousarray(a, dtype=self.dtype).tobytes(), self.level)
+
+        self.__file.write(chunk)
+        self.__offsets.append(self.__offsets[-1] + len(chunk))
+        self.count += 1
+
+    def close(self):
+        self.__file.close()
+        np.save(self.offsets_path, np.array(self.__offsets, dtype=np.int64))
+
+
+class ChunkArray:
+    """Read side of `ChunkAppender`, indexing decompresses a single sample"""
+
+    def __init__(self, path: Path, offsets_path: Path, sample_shape: tuple, dtype: str):
+        self.data = np.memmap(path, dtype=np.uint8, mode="r")
+        self.offsets = np.load(offsets_path)
+
+        self.sample_shape = tuple(sample_shape)
+        self.dtype = np.dtype(dtype)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        chunk = self.data[self.offsets[index]:self.offsets[index + 1]]
+        return np.frombuffer(zlib.decompress(chunk), dtype=self.dtype).reshape(self.sample_shape)
+
+
+def shard_files(shard: dict) -> list[str]:
+    """Paths of a shard's files, relative to the dataset root"""
+
+    rs = [shard[name] for name in SHARD_ARRAYS if name in shard]
+    rs.extend(c["offsets"] for c in shard.get("compressed", {}).values())
+
+    return rs
+
+
+def open_shard(root: Path, shard: dict) -> dict[str, np.ndarray]:
+    """Arrays of a shard, memory-mapped or, for compressed ones, decompressed per sample"""
+
+    compressed = shard.get("compressed", {})
+    arrays = {}
+
+    for name in SHARD_ARRAYS:
+        if name in compressed:
+            c = compressed[name]
+            arrays[name] = ChunkArray(Path(root) / shard[name], Path(root) / c["offsets"], c["shape"], c["dtype"])
+
+        elif name in shard:
+            arrays[name] = np.load(Path(root) / shard[name], mmap_mode="r")
+    return arrays
+
+
+class ShardWriter:
+    """Writes samples sequentially into fixed-size shards of contiguous arrays
+
+    A shard holds samples of a single shape, one `shards/<array>-NNNNN.npy`
+    per array of `SHARD_ARRAYS` (images (N, C, H, W), labels (N, H, W),
+    class histograms (N, NUM_CLASSES), image scales (N, C, 2)), listed in the
+    dataset's index file. With `compress`, images and labels are written as
+    per-sample zlib chunks instead
+
+    Shards whose share of samples still referred to drops below `min_live`
+    are compacted on close, their live samples copied into new shards"""
+
+    def __init__(
+        self,
+        root: Path,
+        shard_size: int = 512,
+        shards: list[dict] = None,
+        compress: bool = False,
+        min_live: float = .5
+    ):
+        self.root = Path(root)
+        (self.root / SHARDS_DIR).mkdir(exist_ok=True, parents=True)
+
+        self.shard_size = shard_size
+        self.compress = compress
+        self.min_live = min_live
+        self.shards: list[dict] = list(shards or [])
+
+        self.__arrays: dict[str, NpyAppender] = None
+
+    def __next_id(self) -> int:
+        return max((s["id"] for s in self.shards), default=-1) + 1
+
+    def __open(self, arrays: dict[str, np.ndarray]):
+        shard_id = self.__next_id()
+        shard = {"id": shard_id, "count": 0}
+
+        self.__arrays = {}
+        for name, a in arrays.items():
+            if self.compress and name in COMPRESSED_ARRAYS:
+                shard[name] = f"{SHARDS_DIR}/{name}-{shard_id:05}.z"
+                self.__arrays[name] = ChunkAppender(self.root / shard[name], a.shape, a.dtype)
+
+                shard.setdefault("compressed", {})[name] = {
+                    "offsets": f"{SHARDS_DIR}/{name}-{shard_id:05}.offsets.npy",
+                    "shape": list(a.shape),
+                    "dtype": np.lib.format.dtype_to_descr(a.dtype), }
+                continue
+
+            shard[name] = f"{SHARDS_DIR}/{name}-{shard_id:05}.npy"
+            self.__arrays[name] = NpyAppender(self.root / shard[name], a.shape, a.dtype, self.shard_size)
+
+        self.shards.append(shard)
+
+    def flush(self):
+        if self.__arrays is None:
+            return
+
+        for appender in self.__arrays.values():
+            appender.close()
+
+        self.shards[-1]["count"] = next(iter(self.__arrays.values())).count
+        self.__arrays = None
+
+    def add(self, **arrays: np.ndarray) -> tuple[int, int]:
+        """Append a sample, one array per name, returns its (shard id, offset)"""
+
+        if self.__arrays is not None and (
+            arrays.keys() != self.__arrays.keys() or
+            any(a.shape != self.__arrays[k].sample_shape or a.dtype != self.__arrays[k].dtype
+                for k, a in arrays.items())
+        ):
+            self.flush()
+
+        if self.__arrays is None:
+            self.__open(arrays)
+
+        offset = self.__arrays["images"].count
+
+        for name, a in arrays.items():
+            self.__arrays[name].append(a)
+
+        if offset + 1 >= self.shard_size:
+            self.flush()
+
+        return self.shards[-1]["id"], offset
+
+    def close(self, rois: dict[str, dict] = None, **index):
+        """Flush the open shard and write the index file, extra keys included
+
+        With `rois` (the manifest, every entry listing its sample `segments`),
+        sparse shards are compacted and shards no ROI refers to anymore are
+        deleted"""
+
+        self.flush()
+
+        dead = []
+        if rois is not None:
+            self.compact(rois)
+
+            live = {seg[0] for r in rois.values() for seg in r["segments"]}
+
+            dead = [s for s in self.shards if s["id"] not in live]
+            self.shards = [s for s in self.shards if s["id"] in live]
+
+            index["rois"] = rois
+
+        path = self.root / INDEX_FILE
+
+        with open(path.with_suffix(".tmp"), "w") as f:
+            json.dump({"version": 1, **index, "shards": self.shards}, f)
+
+        os.replace(path.with_suffix(".tmp"), path)
+
+        # only once the index no longer refers to them
+        for s in dead:
+            for path in shard_files(s):
+                (self.root / path).unlink(missing_ok=True)
+
+    def compact(self, rois: dict[str, dict]) -> int:
+        """Copy the live samples of shards below `min_live` into new shards,
+        updating the ROIs' segments in place, returns the number of shards compacted
+
+        The old shards are left unreferenced, for `close` to delete"""
+
+        used: dict[int, int] = {}
+        for r in rois.values():
+            for shard_id, start, stop in r["segments"]:
+                used[shard_id] = used.get(shard_id, 0) + stop - start
+
+        sparse = {
+            s["id"]: s for s in self.shards
+            if 0 < used.get(s["id"], 0) < self.min_live * s["count"]}
+
+        if not sparse:
+            return 0
+
+        maps: dict[int, dict[str, np.ndarray]] = {}
+
+        for r in rois.values():
+            rs = []
+
+            for shard_id, start, stop in r["segments"]:
+                if shard_id not in sparse:
+                    rs.append([shard_id, start, stop])
+                    continue
+
+                if shard_id not in maps:
+                    maps[shard_id] = open_shard(self.root, sparse[shard_id])
+                arrays = maps[shard_id]
+
+                rs.extend(segments([
+                    self.add(**{name: np.asarray(a[o]) for name, a in arrays.items()})
+                    for o in range(start, stop)]))
+
+            r["segments"] = rs
+
+        self.flush()
+
+        # memory maps released before the files are deleted
+        maps.clear()
+        return len(sparse)
+
+
+class ShardReader:
+    """Zero-copy sample access to a sharded dataset through memory maps
+
+    Maps are opened lazily (and dropped on pickling) so readers can be sent
+    to DataLoader worker processes"""
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+
+        with open(self.root / INDEX_FILE) as f:
+            self.index = json.load(f)
+
+        self.shards: dict[int, dict] = {s["id"]: s for s in self.index["shards"]}
+
+        if "rois" in self.index:
+            locations = [
+                (shard_id, o)
+                for r in self.index["rois"].values()
+                for shard_id, start, stop in r["segments"]
+                for o in range(start, stop)]
+        else:
+            locations = [(s["id"], o) for s in self.index["shards"] for o in range(s["count"])]
+
+        self.samples = np.array(locations, dtype=np.int64).reshape(-1, 2)
+
+        self.__maps: dict[int, dict[str, np.ndarray]] = {}
+
+    @staticmethod
+    def exists(root: Path) -> bool:
+        return (Path(root) / INDEX_FILE).exists()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_ShardReader__maps"] = {}
+
+        return state
+
+    def __len__(self):
+        return len(self.samples)
+
+    def histograms(self) -> np.ndarray:
+        """Class histograms of all samples, (N, NUM_CLASSES), no image is read"""
+
+        rs = np.zeros((len(self.samples), NUM_CLASSES), dtype=np.uint32)
+
+        for shard_id in np.unique(self.samples[:, 0]):
+            idx = np.flatnonzero(self.samples[:, 0] == shard_id)
+            arrays = self.shard(int(shard_id))
+
+            if "histograms" not in arrays:
+                raise ValueError(f"Shard {shard_id} has no class histograms, export the dataset again")
+
+            rs[idx] = arrays["histograms"][self.samples[idx, 1]]
+        return rs
+
+    def shard(self, shard_id: int) -> dict[str, np.ndarray]:
+        if shard_id not in self.__maps:
+            self.__maps[shard_id] = open_shard(self.root, self.shards[shard_id])
+        return self.__maps[shard_id]
+
+    def sample(self, index: int) -> dict[str, np.ndarray]:
+        """Stored arrays of a sample, views into uncompressed shards"""
+
+        shard_id, offset = self.samples[index]
+        return {name: a[offset] for name, a in self.shard(int(shard_id)).items()}
+
+    def __getitem__(self, index: int) -> tuple[np.ndarray, np.ndarray]:
+        """(image (C, H, W), label (H, W)), the image normalized to [0, 1]"""
+
+        sample = self.sample(index)
+
+        if "scales" not in sample:
+            return sample["images"], sample["labels"]
+        return decode(sample["images"], sample["scales"]), sample["labels"]
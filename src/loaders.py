@@ -0,0 +1,216 @@
+# NOTE: no QGIS imports in this module, its datasets are sent to DataLoader worker processes
+
+from rasterio.windows import Window
+
+import torch.utils.data
+import torch
+
+from dataclasses import dataclass, field
+from typing import Optional
+from pathlib import Path
+import numpy as np
+import os
+
+from . import dataset
+
+
+class QsamDataset(torch.utils.data.Dataset):
+    """Exported windows, memory-mapped from the shards or, for datasets
+    exported before sharding, loaded from the per-window .npy files
+
+    With `use_cache`, samples come preprocessed from the cache instead"""
+
+    def __init__(self, ds_path: Path):
+        super().__init__()
+
+        self.ds_path = Path(ds_path)
+
+        self.shards: dataset.ShardReader = None
+
+        self.cache_paths: tuple[Path, Path] = None
+        self.__cache: tuple[np.ndarray, np.ndarray] = None
+
+        if dataset.ShardReader.exists(self.ds_path):
+            self.shards = dataset.ShardReader(self.ds_path)
+            return
+
+        self.images_path = self.ds_path / "images"
+        self.labels_path = self.ds_path / "labels"
+
+        self.images = sorted(self.images_path.glob("*.npy"))
+
+    @staticmethod
+    def exists(ds_path: Path) -> bool:
+        """A sharded or per-window dataset is exported under `ds_path`"""
+
+        return dataset.ShardReader.exists(ds_path) or (Path(ds_path) / "images").is_dir()
+
+    def histograms(self) -> Optional[np.ndarray]:
+        """Class histograms of the windows, None for per-window datasets"""
+
+        if self.shards is None:
+            return None
+        return self.shards.histograms()
+
+    @property
+    def preprocessed(self) -> bool:
+        return self.cache_paths is not None
+
+    def use_cache(self, images_path: Path, labels_path: Path):
+        """Serve the samples preprocessed by `preprocessing.cache_dataset`"""
+
+        self.cache_paths = (images_path, labels_path)
+        self.__cache = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_QsamDataset__cache"] = None
+
+        return state
+
+    def __len__(self):
+        if self.shards is not None:
+            return len(self.shards)
+        return len(self.images)
+
+    def __getitem__(self, index):
+        """(image (C, H, W), label (H, W))"""
+
+        if self.cache_paths is not None:
+            if self.__cache is None:
+                self.__cache = tuple(np.load(p, mmap_mode="r") for p in self.cache_paths)
+
+            images, labels = self.__cache
+            return images[index], labels[index]
+
+        if self.shards is not None:
+            return self.shards[index]
+
+        image_pt = self.images[index]
+        label_pt = self.labels_path / os.path.basename(image_pt)
+
+        return np.load(image_pt), np.load(label_pt).astype(np.uint8)
+
+
+@dataclass
+class StreamRoi:
+    """A ROI of a scene with its label shapes in the raster's CRS, picklable"""
+
+    raster_path: str
+    window: tuple[int, int, int, int]  # col_off, row_off, width, height
+    shapes: list[tuple[dict, int]] = field(default_factory=list)
+
+
+class StreamingDataset(torch.utils.data.IterableDataset):
+    """Random windows cropped on the fly from the ROIs' rasters, no export needed
+
+    ROIs are drawn in proportion to their area, labels are burned in memory.
+    Every DataLoader worker yields its share of `samples_per_epoch` crops from
+    its own random stream, reseeded on every epoch (persistent workers included)"""
+
+    def __init__(
+        self,
+        rois: list[StreamRoi],
+        window_size: int = 256,
+        samples_per_epoch: int = 1000,
+        min_labelled: float = 0.,
+        keep_empty: float = 1.,
+        max_retries: int = 10
+    ):
+        super().__init__()
+
+        self.rois = [r for r in rois if r.window[2] > 0 and r.window[3] > 0]
+        self.window_size = window_size
+        self.samples_per_epoch = samples_per_epoch
+
+        self.min_labelled = min_labelled
+        self.keep_empty = keep_empty
+        self.max_retries = max_retries
+
+        self.epoch = 0
+
+        areas = np.array([r.window[2] * r.window[3] for r in self.rois], dtype=np.float64)
+        self.weights = areas / areas.sum() if len(areas) else areas
+
+    def __len__(self):
+        return self.samples_per_epoch
+
+    def __iter__(self):
+        info = torch.utils.data.get_worker_info()
+
+        if info is None:
+            count = self.samples_per_epoch
+            seed = int(torch.empty((), dtype=torch.int64).random_().item())
+        else:
+            count = self.samples_per_epoch // info.num_workers \
+                + (info.id < self.samples_per_epoch % info.num_workers)
+            seed = info.seed
+
+        # persistent workers keep their seed, the epoch tells their streams apart
+        rng = np.random.default_rng([seed, self.epoch])
+        self.epoch += 1
+
+        # rasters stay open for the epoch only, also when iterated in-process
+        with dataset.raster_handles():
+            for _ in range(count if self.rois else 0):
+                yield self.sample(rng)
+
+    def sample(self, rng: np.random.Generator) -> tuple[np.ndarray, np.ndarray]:
+        """(image (C, H, W), label (H, W)), retried while the crop is filtered out"""
+
+        for _ in range(self.max_retries):
+            image, label = self.crop(self.rois[rng.choice(len(self.rois), p=self.weights)], rng)
+            hists = dataset.histograms(label[None])
+
+            if len(dataset.select_windows(hists, self.min_labelled, self.keep_empty, rng)):
+                break
+        return image, label
+
+    def crop(self, roi: StreamRoi, rng: np.random.Generator) -> tuple[np.ndarray, np.ndarray]:
+        """A random window of the ROI, normalized, padded to `window_size`"""
+
+        col_off, row_off, width, height = roi.window
+        size = self.window_size
+
+        window = Window(
+            col_off + int(rng.integers(0, max(width - size, 0) + 1)),
+            row_off + int(rng.integers(0, max(height - size, 0) + 1)),
+            min(size, width),
+            min(size, height), )
+
+        with dataset.raster_handles():
+            rf = dataset.open_raster(roi.raster_path)
+
+            block = rf.read(window=window)
+            label = dataset.rasterize_labels(roi.shapes, window, rf.window_transform(window))
+
+            if rf.nodata is not None:
+                label[(block == rf.nodata).all(axis=0)] = dataset.IGNORE_INDEX
+
+        images, labels, _ = dataset.tile(block, label, [0], size, size, dataset.Storage.float32)
+        return images[0], labels[0]
+
+
+class Collate:
+    """Stacks (image (C, H, W), label (H, W)) samples into (N, C, H, W) and (N, H, W)
+    tensors, smaller windows padded with 0 and `dataset.IGNORE_INDEX`
+
+    A plain picklable object, so batches can be collated in worker processes,
+    preprocessing is done on the batch by `preprocessing.Preprocessor`"""
+
+    def __call__(self, samples: list[tuple[np.ndarray, np.ndarray]]) -> tuple[torch.Tensor, torch.Tensor]:
+        images, labels = zip(*samples)
+
+        # labels of legacy edge windows can be larger than their clipped image
+        c = images[0].shape[0]
+        h = max(max(image.shape[1], label.shape[0]) for image, label in samples)
+        w = max(max(image.shape[2], label.shape[1]) for image, label in samples)
+
+        x = np.zeros((len(images), c, h, w), dtype=images[0].dtype)
+        y = np.full((len(labels), h, w), dataset.IGNORE_INDEX, dtype=np.uint8)
+
+        for i, (image, label) in enumerate(samples):
+            x[i, :, :image.shape[1], :image.shape[2]] = image
+            y[i, :label.shape[0], :label.shape[1]] = label
+
+        return torch.from_numpy(x), torch.from_numpy(y)
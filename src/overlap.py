@@ -0,0 +1,254 @@
+from qgis.core import (
+    QgsFeature,
+    QgsFeatureRequest,
+    QgsGeometry,
+    QgsProject,
+    QgsSpatialIndex,
+    QgsVectorLayer, )
+
+from .writer import FeatureWriter
+
+
+__all__ = ["OverlapPolicy", "OverlapResolver"]
+
+
+class OverlapPolicy:
+    none = "none"       # write new polygons as they are
+    skip = "skip"       # drop new polygons duplicating an existing one of the same class
+    clip = "clip"       # skip duplicates, clip the rest against existing polygons of any class
+    merge = "merge"     # union with overlapping polygons of the same class
+
+    all = [none, skip, clip, merge]
+
+
+class LayerIndex:
+    """Spatial index over a target layer's polygons and the pending ones
+
+    Committed features are keyed by their fid, pending (buffered) features
+    by negative keys until the writer reports their fid"""
+
+    def __init__(self, layer: QgsVectorLayer, class_field: str = "class"):
+        self.index = QgsSpatialIndex()
+
+        self.geometries: dict[int, QgsGeometry] = {}
+        self.classes: dict[int, int] = {}
+        self.pending: dict[int, QgsFeature] = {}
+
+        self.__keys: dict[int, int] = {}  # id(pending feature) -> key
+        self.__next_key = -1
+
+        field = layer.fields().indexOf(class_field)
+        request = QgsFeatureRequest()
+
+        if field >= 0:
+            request.setSubsetOfAttributes([field])
+        else:
+            request.setNoAttributes()
+
+        for ft in layer.getFeatures(request):
+            self.insert(ft.id(), ft.geometry(), ft.attributes()[field] if field >= 0 else None)
+
+    def insert(self, key: int, geom: QgsGeometry, class_id: int):
+        if geom is None or geom.isEmpty():
+            return
+
+        self.index.addFeature(key, geom.boundingBox())
+
+        self.geometries[key] = geom
+        self.classes[key] = class_id
+
+    def remove(self, key: int):
+        geom = self.geometries.pop(key, None)
+        self.classes.pop(key, None)
+
+        if geom is not None:
+            self.index.deleteFeature(self.__entry(key, geom))
+
+        ft = self.pending.pop(key, None)
+        if ft is not None:
+            self.__keys.pop(id(ft), None)
+
+    def insert_pending(self, ft: QgsFeature, class_id: int):
+        key, self.__next_key = self.__next_key, self.__next_key - 1
+
+        self.pending[key] = ft
+        self.__keys[id(ft)] = key
+
+        self.insert(key, ft.geometry(), class_id)
+
+    def commit_pending(self, ft: QgsFeature, fid: int):
+        key = self.__keys.pop(id(ft), None)
+
+        if key is None:
+            return
+
+        self.pending.pop(key, None)
+        geom, c = self.geometries.get(key), self.classes.get(key)
+
+        self.remove(key)
+        self.insert(fid, geom, c)
+
+    def candidates(self, geom: QgsGeometry) -> list[int]:
+        return [k for k in self.index.intersects(geom.boundingBox()) if k in self.geometries]
+
+    @staticmethod
+    def __entry(key: int, geom: QgsGeometry) -> QgsFeature:
+        ft = QgsFeature(key)
+        ft.setGeometry(geom)
+
+        return ft
+
+
+class OverlapResolver:
+    """Resolve overlaps of new SAM polygons with the target layer's polygons
+
+    Only the index candidates of each new polygon are inspected, so the cost
+    stays logarithmic in the layer size"""
+
+    def __init__(
+        self,
+        writer: FeatureWriter,
+        policy: str = OverlapPolicy.none,
+        iou_threshold: float = .8,
+        class_field: str = "class"
+    ):
+        self.writer = writer
+        self.policy = policy
+        self.iou_threshold = iou_threshold
+        self.class_field = class_field
+
+        self.indexes: dict[str, LayerIndex] = {}
+        self.__connected: set[str] = set()
+
+        self.writer.flushed.connect(self.__on_flushed)
+
+    def index(self, layer: QgsVectorLayer) -> LayerIndex:
+        if layer.id() not in self.indexes:
+            self.indexes[layer.id()] = LayerIndex(layer, class_field=self.class_field)
+
+        if layer.id() not in self.__connected:
+            self.__connected.add(layer.id())
+
+            # edits made outside of QSAM
+            layer.committedFeaturesAdded.connect(self.__on_features_added)
+            layer.committedFeaturesRemoved.connect(self.__on_features_removed)
+            layer.committedGeometriesChanges.connect(lambda *_, l=layer: self.invalidate(l.id()))
+            layer.willBeDeleted.connect(lambda l=layer: self.invalidate(l.id()))
+
+        return self.indexes[layer.id()]
+
+    def invalidate(self, layer_id: str):
+        self.indexes.pop(layer_id, None)
+
+    def resolve(
+        self,
+        layer: QgsVectorLayer,
+        shapes: list[QgsGeometry],
+        class_id: int
+    ) -> tuple[list[QgsGeometry], dict[str, int]]:
+        """Apply the overlap policy to new polygons before they are written
+
+        Returns the polygons to write and how many were skipped, clipped or merged.
+        Duplicates (IoU >= `iou_threshold`) are only those of the same class"""
+
+        counts = {"skipped": 0, "clipped": 0, "merged": 0}
+
+        if self.policy == OverlapPolicy.none:
+            return shapes, counts
+
+        index = self.index(layer)
+        rs = []
+
+        for geom in shapes:
+            clipped = merged = False
+
+            for key in index.candidates(geom):
+                other = index.geometries[key]
+
+                if not geom.intersects(other):
+                    continue
+
+                same_class = index.classes[key] == class_id
+
+                if self.policy == OverlapPolicy.merge:
+                    if same_class and self.__drop(layer, index, key):
+                        geom = geom.combine(other)
+                        merged = True
+                    continue
+
+                if same_class and self.iou(geom, other) >= self.iou_threshold:
+                    geom = None
+                    break
+
+                if self.policy == OverlapPolicy.clip:
+                    geom = geom.difference(other)
+                    clipped = True
+
+                    if geom.isEmpty():
+                        break
+
+            if geom is None or geom.isEmpty():
+                counts["skipped"] += 1
+                continue
+
+            counts["clipped"] += clipped
+            counts["merged"] += merged
+
+            rs.append(geom)
+        return rs, counts
+
+    def add(self, layer: QgsVectorLayer, features: list[QgsFeature], class_id: int):
+        """Track features of `class_id` handed to the writer"""
+
+        if self.policy == OverlapPolicy.none and layer.id() not in self.indexes:
+            return
+
+        index = self.index(layer)
+
+        for ft in features:
+            index.insert_pending(ft, class_id)
+
+    @staticmethod
+    def iou(a: QgsGeometry, b: QgsGeometry) -> float:
+        union = a.combine(b).area()
+        return a.intersection(b).area() / union if union > 0 else 0.
+
+    def __drop(self, layer: QgsVectorLayer, index: LayerIndex, key: int) -> bool:
+        if key < 0:
+            if not self.writer.discard(layer, index.pending[key]):
+                return False
+        else:
+            self.writer.delete(layer, [key])
+
+        index.remove(key)
+        return True
+
+    def __on_flushed(self, layer_id: str, features: list, written: list):
+        index = self.indexes.get(layer_id)
+
+        if index is None:
+            return
+
+        for ft, wt in zip(features, written):
+            index.commit_pending(ft, wt.id())
+
+    def __on_features_added(self, layer_id: str, features: list):
+        index = self.indexes.get(layer_id)
+        layer = QgsProject.instance().mapLayer(layer_id)
+
+        if index is None or layer is None:
+            return
+
+        field = layer.fields().indexOf(self.class_field)
+
+        for ft in features:
+            index.insert(ft.id(), ft.geometry(), ft.attributes()[field] if field >= 0 else None)
+
+    def __on_features_removed(self, layer_id: str, fids: list):
+        index = self.indexes.get(layer_id)
+
+        if index is None:
+            return
+
+        for fid in fids:
+            index.remove(fid)
@@ -0,0 +1,152 @@
+# NOTE: no QGIS imports in this module, it is used by DataLoader worker processes
+
+import torch.nn.functional as F
+import torch.utils.data
+import torch
+
+from dataclasses import dataclass, asdict
+from typing import Callable, Optional
+from pathlib import Path
+import numpy as np
+import hashlib
+
+from . import dataset
+
+
+@dataclass
+class Preprocessor:
+    """Batched torch equivalent of a checkpoint's image processor
+
+    Resize, rescale and normalization are applied to (N, C, H, W) images,
+    nearest neighbour resize and label reduction to (N, H, W) labels"""
+
+    size: tuple[int, int] = None            # (height, width), None keeps the input size
+    rescale_factor: float = None            # applied to integer images only
+    image_mean: tuple[float, ...] = None
+    image_std: tuple[float, ...] = None
+    reduce_labels: bool = False             # 0 becomes ignored, other classes shift down by one
+
+    @classmethod
+    def from_processor(cls, processor) -> "Preprocessor":
+        """Parameters of a HF image processor (e.g. `AutoImageProcessor`)"""
+
+        size = getattr(processor, "size", None) if getattr(processor, "do_resize", False) else None
+
+        if isinstance(size, dict):
+            # windows are square, the shortest edge is the side
+            size = (size["height"], size["width"]) if "height" in size else (size["shortest_edge"],) * 2
+
+        normalize = getattr(processor, "do_normalize", False)
+
+        return cls(
+            size=tuple(size) if size else None,
+            rescale_factor=processor.rescale_factor if getattr(processor, "do_rescale", False) else None,
+            image_mean=tuple(processor.image_mean) if normalize else None,
+            image_std=tuple(processor.image_std) if normalize else None,
+            reduce_labels=bool(getattr(processor, "do_reduce_labels", False)), )
+
+    @classmethod
+    def from_pretrained(cls, checkpoint: str) -> "Preprocessor":
+        from transformers import AutoImageProcessor
+        return cls.from_processor(AutoImageProcessor.from_pretrained(checkpoint))
+
+    def images(self, x: torch.Tensor) -> torch.Tensor:
+        rescale = not x.is_floating_point() and self.rescale_factor is not None
+        x = x.float()
+
+        if rescale:
+            x = x * self.rescale_factor
+
+        if self.size is not None and tuple(x.shape[-2:]) != self.size:
+            x = F.interpolate(x, size=self.size, mode="bilinear", align_corners=False, antialias=True)
+
+        if self.image_mean is not None:
+            x = (x - x.new_tensor(self.image_mean)[:, None, None]) / x.new_tensor(self.image_std)[:, None, None]
+        return x
+
+    def labels(self, y: torch.Tensor) -> torch.Tensor:
+        y = y.long()
+
+        if self.size is not None and tuple(y.shape[-2:]) != self.size:
+            y = F.interpolate(y[:, None].float(), size=self.size, mode="nearest")[:, 0].long()
+
+        if self.reduce_labels:
+            ignored = (y == 0) | (y == dataset.IGNORE_INDEX)
+            y = torch.where(ignored, torch.full_like(y, dataset.IGNORE_INDEX), y - 1)
+        return y
+
+    def __call__(self, images: torch.Tensor, labels: torch.Tensor = None) -> dict[str, torch.Tensor]:
+        """Model inputs, `pixel_values` and `labels` when given"""
+
+        rs = {"pixel_values": self.images(images)}
+
+        if labels is not None:
+            rs["labels"] = self.labels(labels)
+        return rs
+
+
+def cache_key(preprocessor: Preprocessor, root: Path) -> str:
+    """Key of a sharded dataset's preprocessed cache, changes with the dataset's index"""
+
+    index = hashlib.sha1((Path(root) / dataset.INDEX_FILE).read_bytes()).hexdigest()
+    return dataset.digest({"preprocessor": asdict(preprocessor), "index": index})[:12]
+
+
+def cache_dataset(
+    preprocessor: Preprocessor,
+    ds: torch.utils.data.Dataset,
+    root: Path,
+    collate_fn: Callable,
+    batch_size: int = 16,
+    device: str = "cpu",
+    is_canceled: Callable[[], bool] = lambda: False
+) -> Optional[tuple[Path, Path]]:
+    """Preprocess all the samples once into float16 images and uint8 labels
+    under `root/preprocessed`, reused as long as the dataset and the
+    preprocessor are unchanged"""
+
+    key = cache_key(preprocessor, root)
+
+    images_path = Path(root) / "preprocessed" / f"{key}-images.npy"
+    labels_path = Path(root) / "preprocessed" / f"{key}-labels.npy"
+
+    if images_path.exists() and labels_path.exists():
+        return images_path, labels_path
+
+    images_path.parent.mkdir(exist_ok=True, parents=True)
+
+    loader = torch.utils.data.DataLoader(ds, batch_size=batch_size, shuffle=False, collate_fn=collate_fn)
+    images, labels = None, None
+    offset = 0
+
+    for x, y in loader:
+        batch = preprocessor(x.to(device), y.to(device))
+
+        if images is None:
+            images = np.lib.format.open_memmap(
+                images_path.with_suffix(".tmp"), mode="w+", dtype=np.float16,
+                shape=(len(ds), *batch["pixel_values"].shape[1:]))
+            labels = np.lib.format.open_memmap(
+                labels_path.with_suffix(".tmp"), mode="w+", dtype=np.uint8,
+                shape=(len(ds), *batch["labels"].shape[1:]))
+
+        n = len(x)
+
+        images[offset:offset + n] = batch["pixel_values"].half().cpu().numpy()
+        labels[offset:offset + n] = batch["labels"].to(torch.uint8).cpu().numpy()
+        offset += n
+
+        if is_canceled():
+            return None
+
+    if images is None:
+        return None
+
+    images.flush()
+    labels.flush()
+    del images, labels
+
+    images_path.with_suffix(".tmp").replace(images_path)
+    labels_path.with_suffix(".tmp").replace(labels_path)
+
+    return images_path, labels_path
@@ -3,12 +3,15 @@ from qgis.PyQt.QtGui import QIcon
 
 from .train_model import TrainModelAlgorithm
 from .dataset_export import DatasetExportAlgorithm
+from .rois import ImportRoisAlgorithm, ExportRoisAlgorithm
 
 
 class QsamProcessingProvider(QgsProcessingProvider):
     def loadAlgorithms(self):
         self.addAlgorithm(TrainModelAlgorithm())
         self.addAlgorithm(DatasetExportAlgorithm())
+        self.addAlgorithm(ImportRoisAlgorithm())
+        self.addAlgorithm(ExportRoisAlgorithm())
 
     def id(self) -> str:
         return "qsam"
@@ -4,6 +4,7 @@ from qgis.core import (
     QgsProject,
     QgsMapLayer,
     QgsProcessingParameterNumber,
+    QgsProcessingParameterBoolean,
     QgsProcessingParameterFolderDestination,
     QgsProcessingParameterFile,
     QgsReferencedRectangle,
@@ -22,11 +23,14 @@ from qgis.core import (
     QgsProcessingParameterMapLayer,
     QgsProcessingFeedback,
     QgsProcessingParameterFeatureSink,
-    QgsProcessingParameterFeatureSource, )
-
-import processing
-
-import geopandas as gpd
+    QgsProcessingParameterFeatureSource,
+    QgsFeatureRequest,
+    QgsGeometry,
+    QgsProcessingParameterMultipleLayers,
+    QgsSpatialIndex,
+    QgsProcessingException,
+    QgsVectorLayer,
+    NULL, )
 
 from rasterio.transform import rowcol
 from rasterio.windows import Window
@@ -34,11 +38,13 @@ import rasterio.features
 import rasterio.io
 import rasterio
 
+from dataclasses import dataclass
 from pathlib import Path
 import numpy as np
+import json
 import os
 
-from .. import data, utils, consts
+from .. import data, dataset, utils, consts
 
 
 def compute_transform_and_window(bbox: list[int], strf: rasterio.transform.Affine):
@@ -55,6 +61,91 @@ def compute_transform_and_window(bbox: list[int], strf: rasterio.transform.Affin
 
 
 
+def window_from_rectangle(bbox: QgsRectangle, strf: rasterio.transform.Affine) -> Window:
+    """Pixel window of `bbox` (in the raster's CRS), snapped to the raster grid"""
+
+    w = rasterio.windows.from_bounds(
+        bbox.xMinimum(), bbox.yMinimum(), bbox.xMaximum(), bbox.yMaximum(),
+        transform=strf).round_offsets().round_lengths()
+
+    return Window(int(w.col_off), int(w.row_off), int(w.width), int(w.height))
+
+
+class LabelIndex:
+    """Label features of a layer, read once and spatially indexed, shared by
+    all the scenes of an export
+
+    Classes are burned as uint8, ids must be in 0 - 254 (255 is `IGNORE_INDEX`),
+    features without a class are skipped"""
+
+    def __init__(self, layer: QgsVectorLayer, field: str = "class"):
+        self.layer = layer
+        self.index = QgsSpatialIndex()
+        self.features: dict[int, tuple[QgsGeometry, int]] = {}
+
+        request = QgsFeatureRequest().setSubsetOfAttributes([field], layer.fields())
+
+        for ft in layer.getFeatures(request):
+            geom = ft.geometry()
+            value = ft[field]
+
+            if geom.isEmpty() or value is None or value == NULL:
+                continue
+
+            try:
+                class_id = int(value)
+            except (TypeError, ValueError):
+                raise QgsProcessingException(
+                    f"Feature {ft.id()} of {layer.name()} has a non-integer {field}: {value!r}")
+
+            if not 0 <= class_id < dataset.IGNORE_INDEX:
+                raise QgsProcessingException(
+                    f"Feature {ft.id()} of {layer.name()} has {field} {class_id}, "
+                    f"class ids must be in 0 - {dataset.IGNORE_INDEX - 1}")
+
+            self.features[ft.id()] = (geom, class_id)
+            self.index.addFeature(ft.id(), geom.boundingBox())
+
+    def shapes(self, bbox: QgsReferencedRectangle, crs: QgsCoordinateReferenceSystem) -> list[tuple[dict, int]]:
+        """(GeoJSON geometry, class) of the features intersecting `bbox`, in `crs`"""
+
+        to_layer = utils.coordinate_transform(bbox.crs(), self.layer.crs())
+        to_raster = utils.coordinate_transform(self.layer.crs(), crs)
+
+        rs = []
+        for fid in sorted(self.index.intersects(to_layer.transformBoundingBox(bbox))):
+            geom, class_id = self.features[fid]
+
+            geom = QgsGeometry(geom)
+            geom.transform(to_raster)
+
+            rs.append((json.loads(geom.asJson()), class_id))
+        return rs
+
+
+@dataclass
+class Scene:
+    id: str
+    path: str
+    transform: rasterio.Affine
+    bounds: QgsReferencedRectangle
+
+    @classmethod
+    def open(cls, path: str) -> "Scene":
+        with rasterio.open(path) as rf:
+            epsg = rf.crs.to_epsg()
+            crs = QgsCoordinateReferenceSystem.fromEpsgId(epsg) if epsg \
+                else QgsCoordinateReferenceSystem.fromWkt(rf.crs.to_wkt())
+
+            return cls(
+                id=dataset.digest(path)[:12],
+                path=path,
+                transform=rf.transform,
+                bounds=QgsReferencedRectangle(
+                    rectangle=QgsRectangle(rf.bounds.left, rf.bounds.bottom, rf.bounds.right, rf.bounds.top),
+                    crs=crs), )
+
+
 class DatasetExportAlgorithm(QgsProcessingAlgorithm):
     def name(self) -> str:
         return "export_dataset"
@@ -69,7 +160,7 @@ class DatasetExportAlgorithm(QgsProcessingAlgorithm):
     #     return "dataset"
 
     def shortHelpString(self):
-        return "Export ROIs as a dataset"
+        return "Export the ROIs of one or more rasters (scenes) as a single dataset"
 
     def initAlgorithm(self, config: Optional[dict[str, Any]] = None):
         # input raster layer
@@ -86,11 +177,11 @@ class DatasetExportAlgorithm(QgsProcessingAlgorithm):
         default_raster_id = raster_layers[0].id() if raster_layers else None
         default_vector_id = vector_layers[0].id() if vector_layers else None
 
-        self.addParameter(QgsProcessingParameterRasterLayer(
-            name="INPUT_RASTER",
-            description="Input Raster",
-            defaultValue=default_raster_id, )
-            # types=[QgsProcessing.TypeVectorAnyGeometry],
+        self.addParameter(QgsProcessingParameterMultipleLayers(
+            name="INPUT_RASTERS",
+            description="Input Rasters",
+            layerType=QgsProcessing.TypeRaster,
+            defaultValue=[default_raster_id] if default_raster_id else None, )
         )
 
         self.addParameter(QgsProcessingParameterVectorLayer(
@@ -121,6 +212,62 @@ class DatasetExportAlgorithm(QgsProcessingAlgorithm):
             minValue=-1, )
         )
 
+        self.addParameter(QgsProcessingParameterNumber(
+            name="MIN_LABELLED",
+            description="Min. labelled pixel fraction of a window",
+            type=QgsProcessingParameterNumber.Double,
+            defaultValue=0.,
+            minValue=0.,
+            maxValue=1., )
+        )
+
+        self.addParameter(QgsProcessingParameterNumber(
+            name="KEEP_EMPTY",
+            description="Share of windows below it to keep",
+            type=QgsProcessingParameterNumber.Double,
+            defaultValue=.1,
+            minValue=0.,
+            maxValue=1., )
+        )
+
+        self.addParameter(QgsProcessingParameterNumber(
+            name="WORKERS",
+            description="Worker processes",
+            type=QgsProcessingParameterNumber.Integer,
+            defaultValue=1,
+            minValue=1,
+            maxValue=os.cpu_count() or 1, )
+        )
+
+        self.addParameter(QgsProcessingParameterNumber(
+            name="MAX_BLOCK_MB",
+            description="Max. ROI block read at once (MB)",
+            type=QgsProcessingParameterNumber.Integer,
+            defaultValue=256,
+            minValue=1, )
+        )
+
+        self.addParameter(QgsProcessingParameterEnum(
+            name="STORAGE",
+            description="Image Storage",
+            options=["Float32, normalized", "Native raster dtype", "Quantized uint8"],
+            defaultValue=1, )
+        )
+
+        self.addParameter(QgsProcessingParameterBoolean(
+            name="COMPRESS",
+            description="Compress shards",
+            defaultValue=False, )
+        )
+
+        self.addParameter(QgsProcessingParameterNumber(
+            name="SHARD_SIZE",
+            description="Windows per shard",
+            type=QgsProcessingParameterNumber.Integer,
+            defaultValue=512,
+            minValue=1, )
+        )
+
         self.addParameter(QgsProcessingParameterFolderDestination(
             name="OUTPUT_DIR",
             description="Output Directory", )
@@ -132,130 +279,157 @@ class DatasetExportAlgorithm(QgsProcessingAlgorithm):
         context: QgsProcessingContext,
         feedback: QgsProcessingFeedback
     ):
-        vector_layer = QgsProject.instance().mapLayer(params["INPUT_VECTOR"])
-        raster_layer = QgsProject.instance().mapLayer(params["INPUT_RASTER"])
-
-        if raster_layer is not None:
-            raster_layer_path = raster_layer.source()
+        vector_layer = self.parameterAsVectorLayer(params, "INPUT_VECTOR", context)
 
-        elif os.path.exists(params["INPUT_RASTER"]):
-            raster_layer_path = params["INPUT_RASTER"]
+        scenes = [
+            Scene.open(lyr.source())
+            for lyr in self.parameterAsLayerList(params, "INPUT_RASTERS", context)]
+        scenes = list({s.id: s for s in scenes}.values())
 
-        rf: rasterio.DatasetReader = rasterio.open(raster_layer_path)
-        bounds = QgsReferencedRectangle(
-            rectangle=QgsRectangle(rf.bounds.left, rf.bounds.bottom, rf.bounds.right, rf.bounds.top),
-            crs=QgsCoordinateReferenceSystem.fromEpsgId(rf.crs.to_epsg()), )
-
-        db = data.DataStore(params["DB_FILE"])
+        # one index over the label features, whatever the number of scenes
+        labels = LabelIndex(vector_layer)
 
         p_window_size = params["WINDOW_SIZE"]
         p_stride = params["STRIDE"] if params["STRIDE"] != -1 else p_window_size
 
         p_output_dir = Path(params["OUTPUT_DIR"])
 
-        images_output_dir = p_output_dir / "images"
-        images_output_dir.mkdir(exist_ok=True, parents=True)
+        # manifest of the previous export, ROIs whose entry is unchanged are kept as is
+        index = dataset.load_index(p_output_dir)
+        previous: dict[str, dict] = index.get("rois", {})
 
-        labels_output_dir = p_output_dir / "labels"
-        labels_output_dir.mkdir(exist_ok=True, parents=True)
+        writer = dataset.ShardWriter(
+            p_output_dir,
+            shard_size=params.get("SHARD_SIZE", 512),
+            shards=index.get("shards", []) if "rois" in index else [],
+            compress=params.get("COMPRESS", False), )
 
-        bboxes = db.list_rois(bounds)
-        i_counter = 0
+        p_min_labelled = params.get("MIN_LABELLED", 0.)
+        p_keep_empty = params.get("KEEP_EMPTY", .1)
+        p_storage = dataset.Storage.all[params.get("STORAGE", 1)]
+
+        p_hash = dataset.digest({
+            "window_size": p_window_size,
+            "stride": p_stride,
+            "min_labelled": p_min_labelled,
+            "keep_empty": p_keep_empty,
+            "storage": p_storage, })
 
-        for i, bbox in enumerate(bboxes):
-            r_cof, r_rof = rowcol(rf.transform, bbox.xMinimum(), bbox.yMaximum())
-
-            # TODO: Fix rasterizing
-
-            # rasterize
-            # mf = gpd.read_file(vector_layer.dataProvider().dataSourceUri())
-            # mf = gpd.read_file(buffer["OUTPUT"])
-            # feedback.pushInfo(f"{[(shp, 1) for shp in mf['geometry']]}")
-
-            # transform = compute_transform_and_window(
-            #     [bbox.xMinimum(), bbox.yMinimum(), bbox.xMaximum(), bbox.yMaximum()],
-            #     rf.transform)
-
-            # mask = rasterio.features.rasterize(
-            #     # shapes=[(shp, 1) for shp in mf["geometry"]],
-            #     shapes=[(shp, 1) for shp in mf["geometry"]],
-            #     out_shape=(bbox.height(), bbox.width()),
-            #     transform=transform,
-            #     fill=0,
-            #     all_touched=True
-            # )
-
-            # feedback.pushInfo(f"{mask.shape}")
-
-            # Assume vector_layer and bbox are defined
-            tmp_path = QgsProcessingUtils.generateTempFilename(f"temp_output {i:03}.tif", context)
-            os.makedirs(os.path.dirname(tmp_path), exist_ok=True)
-
-            rasterize_params = {
-                "INPUT": utils.get_vector_layer_uri(vector_layer),
-                # "INPUT": buffer["OUTPUT"],
-                "FIELD": "class",
-                "USE_Z": False,
-                "UNITS": 0,
-                "WIDTH": int(bbox.width()),
-                "HEIGHT": int(bbox.height()),
-                "EXTENT": utils.extent_str_from_rectangle(bbox),
-                "NODATA": 0,
-                "OPTIONS": "",
-                "DATA_TYPE": 5,
-                "INIT": None,
-                "INVERT": False,
-                "EXTRA": "",
-                "OUTPUT": QgsProcessing.TEMPORARY_OUTPUT
-            }
-
-            res = processing.run(
-                "gdal:rasterize",
-                parameters=rasterize_params,
-                is_child_algorithm=True,
-                context=context,
-                feedback=feedback)
-
-            feedback.pushDebugInfo(f"gdal:rasterize — {rasterize_params}")
-            feedback.pushInfo(f"Rasterized Vector {i:03}: {res['OUTPUT']}")
-
-            # rl = QgsRasterLayer(res["OUTPUT"], f"raster boxes {i:03}")
-            # QgsProject.instance().addMapLayer(rl)
-
-            with rasterio.open(res["OUTPUT"]) as vf:
-                v_cof, v_rof = rowcol(vf.transform, bbox.xMinimum(), bbox.yMaximum())
-
-                for ws in range(0, int(round(bbox.width())) + 1, p_stride):
-                    for hs in range(0, int(round(bbox.height())) + 1, p_stride):
-                        rw = Window(r_cof + ws, r_rof + hs, p_window_size, p_window_size)
-                        # intersect within bbox bounds
-                        rw = rw.intersection(Window(
-                            r_cof, r_rof,
-                            int(round(bbox.width())), int(round(bbox.height())),))
-
-                        vw = Window(v_cof + ws, v_rof + hs, p_window_size, p_window_size)
-
-                        image = rf.read(window=rw)
-                        image = utils.normalize(image)
-                        feedback.pushDebugInfo("{} {}".format(image.shape, image.dtype))
-
-                        label = vf.read(1, window=vw)
-                        feedback.pushDebugInfo("{} {}".format(label.shape, np.unique(label),))
-
-                        # write arrays
-                        np.save(images_output_dir / f"{i_counter:04}.npy", image)
-                        np.save(labels_output_dir / f"{i_counter:04}.npy", label)
-
-                        i_counter += 1
-
-                        if consts.MODE_DEBUG:
-                            import matplotlib.pyplot as pt
-
-                            (p_output_dir / "images-png").mkdir(exist_ok=True, parents=True)
-                            pt.imsave(p_output_dir / "images-png" / f"{i_counter:04}.png", np.stack(image, axis=2))
-
-                            (p_output_dir / "labels-png").mkdir(exist_ok=True, parents=True)
-                            pt.imsave(p_output_dir / "labels-png" / f"{i_counter:04}.png", label)
+        # ROIs routed to the scenes they intersect, through the ROI index
+        db = data.DataStore(params["DB_FILE"])
+        rois = [(scene, roi_id, bbox) for scene in scenes for roi_id, bbox in db.roi_extents(scene.bounds)]
+        db.close()
+        manifest: dict[str, dict] = {}
+
+        # new or changed ROIs, split from the unchanged ones before any job runs
+        changed: list[tuple[str, dict, dataset.ExportJob]] = []
+
+        # label features are queried here, only workers touch the pixels
+        for i, (scene, roi_id, bbox) in enumerate(rois):
+            roi_window = window_from_rectangle(bbox, scene.transform)
+            shapes = labels.shapes(bbox, scene.bounds.crs())
+
+            key = f"{scene.id}/{roi_id}"
+            entry = {
+                "roi_id": roi_id,
+                "scene": scene.id,
+                "raster_source": scene.path,
+                "extent": [roi_window.col_off, roi_window.row_off, roi_window.width, roi_window.height],
+                "params": p_hash,
+                "labels": dataset.digest(shapes), }
+
+            old = previous.get(key)
+
+            if old is not None and all(old.get(k) == v for k, v in entry.items()):
+                manifest[key] = old
+                continue
+
+            feedback.pushDebugInfo(f"ROI {key}: {len(shapes)} features, {roi_window}")
+
+            changed.append((key, entry, dataset.ExportJob(
+                index=i,
+                raster_path=scene.path,
+                window=tuple(entry["extent"]),
+                shapes=shapes,
+                window_size=p_window_size,
+                stride=p_stride,
+                max_block=params.get("MAX_BLOCK_MB", 256) * 2 ** 20,
+                storage=p_storage,
+                min_labelled=p_min_labelled,
+                keep_empty=p_keep_empty,
+                seed=roi_id, )))
+
+        # ROIs no longer in the DB (or the raster) lose their samples
+        stale = set(previous) - set(manifest) - {key for key, _, _ in changed}
+
+        i_counter = 0
+        exported = 0
+
+        results = dataset.run_jobs(
+            dataset.export_roi, (job for _, _, job in changed),
+            workers=params.get("WORKERS", 1),
+            is_canceled=feedback.isCanceled)
+
+        try:
+            for i, samples in enumerate(results):
+                locations = []
+
+                for k in range(len(samples.get("images", []))):
+                    locations.append(writer.add(**{name: a[k] for name, a in samples.items()}))
+                    i_counter += 1
+
+                    if consts.MODE_DEBUG:
+                        import matplotlib.pyplot as pt
+
+                        image = dataset.decode(samples["images"][k], samples["scales"][k])
+                        label = samples["labels"][k]
+
+                        (p_output_dir / "images-png").mkdir(exist_ok=True, parents=True)
+                        pt.imsave(p_output_dir / "images-png" / f"{i_counter:04}.png", np.stack(image, axis=2))
+
+                        (p_output_dir / "labels-png").mkdir(exist_ok=True, parents=True)
+                        pt.imsave(p_output_dir / "labels-png" / f"{i_counter:04}.png", label)
+
+                key, entry, _ = changed[i]
+                classes = samples["histograms"].sum(axis=0) if samples else np.zeros(dataset.NUM_CLASSES)
+
+                manifest[key] = {
+                    **entry,
+                    "segments": dataset.segments(locations),
+                    # labelled pixels per class over the kept windows
+                    "classes": {str(c): int(classes[c]) for c in np.flatnonzero(classes)}, }
+
+                exported += 1
+                feedback.setProgress(100 * exported / max(len(changed), 1))
+
+        finally:
+            # workers shut down, in-process raster handles closed
+            results.close()
+
+            if exported < len(changed):
+                # canceled or failed, ROIs not exported again keep their previous samples
+                for key, old in previous.items():
+                    manifest.setdefault(key, old)
+
+            # new shards are recorded either way
+            writer.close(
+                rois=manifest,
+                scenes={
+                    s.id: {"source": s.path, "crs": s.bounds.crs().authid() or s.bounds.crs().toWkt()}
+                    for s in scenes},
+                window_size=p_window_size,
+                stride=p_stride,
+                ignore_index=dataset.IGNORE_INDEX, )
+
+        if exported < len(changed):
+            feedback.pushWarning(
+                f"Export canceled after {exported} of {len(changed)} new or changed ROIs, "
+                "the others keep their previous samples")
+
+        feedback.pushInfo(
+            f"Exported {i_counter} windows of {len(scenes)} scenes from {exported} new or changed ROIs, "
+            f"{len(rois) - len(changed)} unchanged, "
+            f"{len(stale) if exported == len(changed) else 0} removed, {len(writer.shards)} shards")
 
         return {
             "OUTPUT_DIR": p_output_dir,
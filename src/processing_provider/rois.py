@@ -0,0 +1,231 @@
+from typing import Any, Optional
+
+from qgis.core import (
+    QgsApplication,
+    QgsCoordinateReferenceSystem,
+    QgsFeature,
+    QgsFeatureSink,
+    QgsField,
+    QgsFields,
+    QgsGeometry,
+    QgsProcessing,
+    QgsProcessingAlgorithm,
+    QgsProcessingContext,
+    QgsProcessingFeedback,
+    QgsProcessingParameterBoolean,
+    QgsProcessingParameterCrs,
+    QgsProcessingParameterFeatureSink,
+    QgsProcessingParameterFeatureSource,
+    QgsProcessingParameterFile,
+    QgsProcessingParameterNumber,
+    QgsProcessingParameterRasterLayer,
+    QgsProcessingParameterString,
+    QgsReferencedRectangle,
+    QgsWkbTypes, )
+
+from PyQt5.QtCore import QVariant
+
+import time
+
+from .. import data, tasks, utils
+
+
+class ImportRoisAlgorithm(QgsProcessingAlgorithm):
+    def __init__(self):
+        super().__init__()
+
+        # (DB file, ids) of the ROIs imported by the run
+        self.__imported: tuple[str, list[int]] = (None, [])
+
+    def name(self) -> str:
+        return "import_rois"
+
+    def displayName(self) -> str:
+        return "Import ROIs"
+
+    def shortHelpString(self):
+        return "Bulk load the extents of a layer's features as ROIs"
+
+    def initAlgorithm(self, config: Optional[dict[str, Any]] = None):
+        self.addParameter(QgsProcessingParameterFeatureSource(
+            name="INPUT",
+            description="ROI features",
+            types=[QgsProcessing.TypeVectorPolygon], )
+        )
+
+        self.addParameter(QgsProcessingParameterFile(
+            name="DB_FILE",
+            description="ROIs database file", )
+        )
+
+        self.addParameter(QgsProcessingParameterRasterLayer(
+            name="INPUT_RASTER",
+            description="Source Raster",
+            optional=True, )
+        )
+
+        self.addParameter(QgsProcessingParameterBoolean(
+            name="QUEUE_EMBEDDING",
+            description="Queue SAM embedding of the imported ROIs (needs a source raster)",
+            defaultValue=False, )
+        )
+
+        self.addParameter(QgsProcessingParameterString(
+            name="MODEL_CHECKPOINT",
+            description="SAM Checkpoint",
+            defaultValue="facebook/sam-vit-large", )
+        )
+
+        self.addParameter(QgsProcessingParameterNumber(
+            name="RESOLUTION",
+            description="SAM Resolution",
+            type=QgsProcessingParameterNumber.Integer,
+            defaultValue=1000,
+            minValue=200,
+            maxValue=10000, )
+        )
+
+    def processAlgorithm(
+        self,
+        params: dict[str, Any],
+        context: QgsProcessingContext,
+        feedback: QgsProcessingFeedback
+    ):
+        source = self.parameterAsSource(params, "INPUT", context)
+        raster_layer = self.parameterAsRasterLayer(params, "INPUT_RASTER", context)
+
+        crs = source.sourceCrs()
+        time_start = time.perf_counter()
+
+        rects = []
+        for ft in source.getFeatures():
+            if feedback.isCanceled():
+                return {}
+
+            if ft.hasGeometry():
+                rects.append(QgsReferencedRectangle(ft.geometry().boundingBox(), crs))
+
+        # the SAM resolution of the queued embeddings
+        resolution = params["RESOLUTION"] if params["QUEUE_EMBEDDING"] and raster_layer is not None else None
+
+        db = data.DataStore(params["DB_FILE"])
+        roi_ids = db.insert_rois(rects, layer=raster_layer, resolution=resolution)
+        db.close()
+
+        self.__imported = (params["DB_FILE"], roi_ids)
+
+        time_taken = time.perf_counter() - time_start
+        feedback.pushInfo(
+            f"Imported {len(roi_ids)} ROIs — "
+            f"{len(roi_ids) / max(time_taken, 1e-9):.0f} rows/s")
+
+        if params["QUEUE_EMBEDDING"] and raster_layer is not None and roi_ids:
+            task = tasks.SamBatchEmbedTask(
+                checkpoint=params["MODEL_CHECKPOINT"],
+                raster_source=raster_layer.source(),
+                raster_provider=raster_layer.providerType(),
+                roi_ids=roi_ids,
+                db_path=params["DB_FILE"],
+                resolution=params["RESOLUTION"],
+                description="QSAM Batch Embed")
+
+            task_id = QgsApplication.instance().taskManager().addTask(task=task,)
+            feedback.pushInfo(f"Batch embed requested {{task_id: {task_id}}}")
+
+        return {"COUNT": len(roi_ids)}
+
+    def postProcessAlgorithm(self, context: QgsProcessingContext, feedback: QgsProcessingFeedback):
+        """On the main thread: the plugin's store on the same file shows the imported ROIs"""
+
+        db_file, roi_ids = self.__imported
+
+        if roi_ids:
+            for db in data.DataStore.opened(db_file):
+                db.notify_inserted(roi_ids)
+
+        return {"COUNT": len(roi_ids)}
+
+    @classmethod
+    def createInstance(cls):
+        return cls()
+
+
+class ExportRoisAlgorithm(QgsProcessingAlgorithm):
+    def name(self) -> str:
+        return "export_rois"
+
+    def displayName(self) -> str:
+        return "Export ROIs"
+
+    def shortHelpString(self):
+        return "Dump the ROIs database into a polygon layer"
+
+    def initAlgorithm(self, config: Optional[dict[str, Any]] = None):
+        self.addParameter(QgsProcessingParameterFile(
+            name="DB_FILE",
+            description="ROIs database file", )
+        )
+
+        self.addParameter(QgsProcessingParameterCrs(
+            name="TARGET_CRS",
+            description="Target CRS",
+            defaultValue="ProjectCrs", )
+        )
+
+        self.addParameter(QgsProcessingParameterFeatureSink(
+            name="OUTPUT",
+            description="ROIs",
+            type=QgsProcessing.TypeVectorPolygon, )
+        )
+
+    def processAlgorithm(
+        self,
+        params: dict[str, Any],
+        context: QgsProcessingContext,
+        feedback: QgsProcessingFeedback
+    ):
+        crs: QgsCoordinateReferenceSystem = self.parameterAsCrs(params, "TARGET_CRS", context)
+
+        fields = QgsFields()
+        fields.append(QgsField("id", QVariant.Int))
+        fields.append(QgsField("raster_source", QVariant.String))
+        fields.append(QgsField("layer_id", QVariant.String))
+        fields.append(QgsField("resolution", QVariant.Double))
+        fields.append(QgsField("checkpoint", QVariant.String))
+        fields.append(QgsField("embedding_key", QVariant.String))
+        fields.append(QgsField("annotation_count", QVariant.Int))
+
+        sink, dest_id = self.parameterAsSink(
+            params, "OUTPUT", context, fields, QgsWkbTypes.Polygon, crs)
+
+        db = data.DataStore(params["DB_FILE"])
+        records = db.list_records()
+        db.close()
+
+        time_start = time.perf_counter()
+
+        features = []
+        for r in records:
+            geom = QgsGeometry.fromRect(r.rect)
+            geom.transform(utils.coordinate_transform(r.rect.crs(), crs))
+
+            ft = QgsFeature(fields)
+            ft.setGeometry(geom)
+            ft.setAttributes([
+                r.id, r.raster_source, r.layer_id, r.resolution,
+                r.checkpoint, r.embedding_key, r.annotation_count])
+
+            features.append(ft)
+
+        sink.addFeatures(features, QgsFeatureSink.FastInsert)
+
+        time_taken = time.perf_counter() - time_start
+        feedback.pushInfo(
+            f"Exported {len(features)} ROIs — "
+            f"{len(features) / max(time_taken, 1e-9):.0f} rows/s")
+
+        return {"OUTPUT": dest_id}
+
+    @classmethod
+    def createInstance(cls):
+        return cls()
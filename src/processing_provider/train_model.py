@@ -47,7 +47,10 @@ from qgis.core import (
     QgsProcessingParameterMapLayer,
     QgsProcessingFeedback,
     QgsProcessingParameterFeatureSink,
-    QgsProcessingParameterFeatureSource, )
+    QgsProcessingParameterFeatureSource,
+    QgsProcessingParameterMultipleLayers,
+    QgsProcessingParameterBoolean,
+    QgsProcessingException, )
 
 import processing
 
@@ -63,32 +66,28 @@ from pathlib import Path
 import numpy as np
 import os
 
-from .. import data, utils, consts
+from .. import data, dataset, loaders, preprocessing, utils, consts
+from ..loaders import QsamDataset
+from .dataset_export import LabelIndex, Scene, window_from_rectangle
 
 class Types:
     unet = 0
     model2 = "ResNet"
 
 
-class QsamDataset(torch.utils.data.Dataset):
-    def __init__(self, ds_path: Path):
-        super().__init__()
-
-        self.ds_path = Path(ds_path)
-
-        self.images_path = self.ds_path / "images"
-        self.labels_path = self.ds_path / "labels"
+class Sources:
+    dataset = "dataset"     # windows exported by qsam:export_dataset
+    stream = "stream"       # random windows cropped from the ROIs' rasters
 
-        self.images = list(self.images_path.glob("*.npy"))
+    all = [dataset, stream]
 
-    def __len__(self):
-        return len(self.images)
 
-    def __getitem__(self, index):
-        image_pt = self.images[index]
-        label_pt = self.labels_path / os.path.basename(image_pt)
+class Samplers:
+    uniform = "uniform"
+    frequency = "frequency"
+    balanced = "balanced"
 
-        return np.stack(np.load(image_pt), axis=2), np.load(label_pt).astype(np.uint8)
+    all = [uniform, frequency, balanced]
 
 
 class TrainModelAlgorithm(QgsProcessingAlgorithm):
@@ -134,37 +133,223 @@ class TrainModelAlgorithm(QgsProcessingAlgorithm):
             minValue=1, )
         )
 
+        self.addParameter(QgsProcessingParameterNumber(
+            name="NUM_WORKERS",
+            description="DataLoader workers (0 loads in the training loop)",
+            defaultValue=2,
+            minValue=0,
+            maxValue=os.cpu_count() or 1, )
+        )
+
+        self.addParameter(QgsProcessingParameterNumber(
+            name="PREFETCH_FACTOR",
+            description="Batches prefetched per worker",
+            defaultValue=2,
+            minValue=1, )
+        )
+
+        self.addParameter(QgsProcessingParameterBoolean(
+            name="PERSISTENT_WORKERS",
+            description="Keep workers alive between epochs",
+            defaultValue=True, )
+        )
+
+        self.addParameter(QgsProcessingParameterEnum(
+            name="SAMPLER",
+            description="Window Sampling",
+            options=["Uniform", "Inverse class frequency", "Class balanced"],
+            defaultValue=0, )
+        )
+
+        self.addParameter(QgsProcessingParameterBoolean(
+            name="CACHE_PREPROCESSED",
+            description="Cache preprocessed windows in the dataset",
+            defaultValue=False, )
+        )
+
+        self.addParameter(QgsProcessingParameterEnum(
+            name="SOURCE",
+            description="Training Windows",
+            options=["Exported dataset", "Streamed from the ROIs"],
+            defaultValue=0, )
+        )
+
         self.addParameter(QgsProcessingParameterFolderDestination(
             name="DATASET_DIR",
-            description="Dataset Directory", )
+            description="Dataset Directory",
+            optional=True, )
         )
 
+        self.addParameter(QgsProcessingParameterFile(
+            name="DB_FILE",
+            description="ROIs database file (streaming)",
+            optional=True, )
+        )
+
+        self.addParameter(QgsProcessingParameterMultipleLayers(
+            name="INPUT_RASTERS",
+            description="Input Rasters (streaming)",
+            layerType=QgsProcessing.TypeRaster,
+            optional=True, )
+        )
+
+        self.addParameter(QgsProcessingParameterVectorLayer(
+            name="INPUT_VECTOR",
+            description="Input Vector (streaming)",
+            optional=True, )
+        )
+
+        self.addParameter(QgsProcessingParameterNumber(
+            name="WINDOW_SIZE",
+            description="Window Size (streaming)",
+            defaultValue=256,
+            minValue=1, )
+        )
+
+        self.addParameter(QgsProcessingParameterNumber(
+            name="SAMPLES_PER_EPOCH",
+            description="Windows per epoch (streaming)",
+            defaultValue=1000,
+            minValue=1, )
+        )
 
         self.addParameter(QgsProcessingParameterFolderDestination(
             name="OUTPUT_DIR",
             description="Train Output Directory", )
         )
 
-    def __collate_fn(self, args, processor: AutoImageProcessor, feedback: QgsProcessingFeedback):
-        # args is (batch_size, 2 -> (image, label), ::)
-        images = []
-        labels = []
+    def checkParameterValues(self, params: dict[str, Any], context: QgsProcessingContext) -> tuple[bool, str]:
+        """Inputs of the selected source, they are all optional for the other one"""
+
+        ok, msg = super().checkParameterValues(params, context)
+        if not ok:
+            return ok, msg
 
-        for image, label in args:
-            images.append(np.array(image))
-            labels.append(np.array(label))
+        if Sources.all[self.parameterAsEnum(params, "SOURCE", context)] == Sources.stream:
+            db_file = self.parameterAsFile(params, "DB_FILE", context)
 
-        inps = processor(
-            images=images,
-            segmentation_maps=labels,
-            return_tensors="pt", )
+            if not db_file or not os.path.isfile(db_file):
+                return False, "Streaming needs the ROIs database file (DB_FILE)"
+            if self.parameterAsVectorLayer(params, "INPUT_VECTOR", context) is None:
+                return False, "Streaming needs the labels vector layer (INPUT_VECTOR)"
+            if not self.parameterAsLayerList(params, "INPUT_RASTERS", context):
+                return False, "Streaming needs at least one input raster (INPUT_RASTERS)"
 
-        return inps
+        else:
+            ds_dir = params.get("DATASET_DIR")
+
+            if not ds_dir or not isinstance(ds_dir, str) or not QsamDataset.exists(Path(ds_dir)):
+                return False, "Training on an exported dataset needs its directory (DATASET_DIR)"
+
+        return True, ""
+
+    @staticmethod
+    def sampler(
+        ds: torch.utils.data.Dataset,
+        mode: str,
+        feedback: QgsProcessingFeedback
+    ) -> Optional[torch.utils.data.Sampler]:
+        """Weighted window sampler from the dataset's class histograms, None for uniform shuffling"""
+
+        if mode == Samplers.uniform or isinstance(ds, torch.utils.data.IterableDataset):
+            return None
+
+        hists = ds.histograms()
+
+        if hists is None:
+            feedback.pushWarning("Dataset has no class histograms, sampling windows uniformly")
+            return None
+
+        weights = dataset.sample_weights(hists, mode=mode)
+
+        # expected share of each class's pixels in the draws
+        shares = weights @ hists[:, :dataset.IGNORE_INDEX]
+        feedback.pushDebugInfo(
+            f"Sampler {mode}: "
+            + ", ".join(f"{c}: {shares[c] / shares.sum():.3f}" for c in np.flatnonzero(shares)))
+
+        return torch.utils.data.WeightedRandomSampler(
+            weights=torch.as_tensor(weights, dtype=torch.double),
+            num_samples=len(ds),
+            replacement=True, )
+
+    def stream_dataset(
+        self,
+        params: dict[str, Any],
+        context: QgsProcessingContext,
+        feedback: QgsProcessingFeedback
+    ) -> loaders.StreamingDataset:
+        """Windows streamed from the DB's ROIs, label shapes are collected here once"""
+
+        labels = LabelIndex(self.parameterAsVectorLayer(params, "INPUT_VECTOR", context))
+        scenes = [Scene.open(lyr.source()) for lyr in self.parameterAsLayerList(params, "INPUT_RASTERS", context)]
+
+        db = data.DataStore(params["DB_FILE"])
+        extents = [(scene, bbox) for scene in scenes for _, bbox in db.roi_extents(scene.bounds)]
+        db.close()
+
+        rois = []
+        for scene, bbox in extents:
+            w = window_from_rectangle(bbox, scene.transform)
+
+            rois.append(loaders.StreamRoi(
+                raster_path=scene.path,
+                window=(w.col_off, w.row_off, w.width, w.height),
+                shapes=labels.shapes(bbox, scene.bounds.crs()), ))
+
+        if not rois:
+            raise QgsProcessingException("No ROIs of the database intersect the input rasters")
+
+        feedback.pushInfo(f"Streaming windows from {len(rois)} ROIs")
+
+        return loaders.StreamingDataset(
+            rois,
+            window_size=params.get("WINDOW_SIZE", 256),
+            samples_per_epoch=params.get("SAMPLES_PER_EPOCH", 1000), )
+
+    @staticmethod
+    def loader_options(params: dict, device: str) -> dict:
+        """DataLoader worker and prefetch options, workers run in spawned processes"""
+
+        workers = params.get("NUM_WORKERS", 2)
+        options = {"pin_memory": str(device).startswith("cuda")}
+
+        if workers > 0:
+            options.update({
+                "num_workers": workers,
+                "prefetch_factor": params.get("PREFETCH_FACTOR", 2),
+                "persistent_workers": params.get("PERSISTENT_WORKERS", True),
+                "multiprocessing_context": dataset.mp_context(), })
+        return options
+
+    @staticmethod
+    def cache_preprocessed(
+        ds: torch.utils.data.Dataset,
+        preprocessor: preprocessing.Preprocessor,
+        params: dict,
+        feedback: QgsProcessingFeedback
+    ):
+        if not isinstance(ds, QsamDataset) or ds.shards is None:
+            feedback.pushWarning("Only sharded exported datasets can be cached, preprocessing every batch")
+            return
+
+        feedback.pushInfo("Caching preprocessed windows")
+
+        paths = preprocessing.cache_dataset(
+            preprocessor, ds, ds.ds_path,
+            collate_fn=loaders.Collate(),
+            batch_size=params["BATCH_SIZE"],
+            device=params.get("DEVICE", "mps"),
+            is_canceled=feedback.isCanceled, )
+
+        if paths is not None:
+            ds.use_cache(*paths)
 
     def train_fn(
         self,
         model: AutoModelForSemanticSegmentation,
         processor: AutoImageProcessor,
+        preprocessor: preprocessing.Preprocessor,
         dataset: torch.utils.data.Dataset,
         params: dict,
         feedback: QgsProcessingFeedback,
@@ -176,11 +361,16 @@ class TrainModelAlgorithm(QgsProcessingAlgorithm):
         # -----------------------------
         # prepare dataloader
 
+        sampler = self.sampler(dataset, Samplers.all[params.get("SAMPLER", 0)], feedback)
+
         dataloader = torch.utils.data.DataLoader(
             dataset,
             batch_size=params["BATCH_SIZE"],
-            shuffle=True,
-            collate_fn=lambda *args, **kw: self.__collate_fn(*args, **kw, processor=processor, feedback=feedback),
+            shuffle=sampler is None and not isinstance(dataset, torch.utils.data.IterableDataset),
+            sampler=sampler,
+            collate_fn=loaders.Collate(),
+            # batches are loaded and collated ahead of the training loop
+            **self.loader_options(params, device),
         )
 
         # -----------------------------
@@ -192,8 +382,22 @@ class TrainModelAlgorithm(QgsProcessingAlgorithm):
 
             tr_losses = []
 
-            for batch in dataloader:
-                outs = model(**batch.to(device))
+            # time spent waiting on the input pipeline vs. in the model
+            time_data, time_compute = 0., 0.
+            time_step = time.perf_counter()
+
+            for step, (images, labels) in enumerate(dataloader):
+                time_loaded = time.perf_counter()
+
+                images = images.to(device, non_blocking=True)
+                labels = labels.to(device, non_blocking=True)
+
+                if getattr(dataset, "preprocessed", False):
+                    batch = {"pixel_values": images.float(), "labels": labels.long()}
+                else:
+                    batch = preprocessor(images, labels)
+
+                outs = model(**batch)
 
                 loss = outs.loss
                 tr_losses.append(loss.item())
@@ -202,12 +406,27 @@ class TrainModelAlgorithm(QgsProcessingAlgorithm):
                 loss.backward()
                 optimizer.step()
 
+                time_data += time_loaded - time_step
+                time_compute += time.perf_counter() - time_loaded
+
+                feedback.pushDebugInfo(
+                    f"Step {step:04} — "
+                    f"data: {time_loaded - time_step:.3f}s — "
+                    f"compute: {time.perf_counter() - time_loaded:.3f}s")
+
+                time_step = time.perf_counter()
+
+                if feedback.isCanceled():
+                    break
+
             tr_loss = np.mean(tr_losses)
 
             feedback.pushInfo(
                 f"Epoch {e:02} — "
                 f"train loss: {tr_loss} — "
-                f"time taken: {time.time() - time_start}")
+                f"time taken: {time.time() - time_start} — "
+                f"data wait: {time_data:.1f}s ({100 * time_data / max(time_data + time_compute, 1e-9):.0f}%) — "
+                f"compute: {time_compute:.1f}s")
 
             if tr_loss < global_min_loss:
                 global_min_loss = tr_loss
@@ -231,9 +450,14 @@ class TrainModelAlgorithm(QgsProcessingAlgorithm):
         # -----------------------------
         feedback.pushInfo("Preparing Dataset & DataLoader")
 
-        p_dataset_path = Path(params["DATASET_DIR"])
+        if Sources.all[params.get("SOURCE", 0)] == Sources.stream:
+            dataset = self.stream_dataset(params, context, feedback)
+        else:
+            dataset = QsamDataset(Path(params["DATASET_DIR"]))
+
+            if len(dataset) == 0:
+                raise QgsProcessingException(f"No windows in the dataset {params['DATASET_DIR']}")
 
-        dataset = QsamDataset(p_dataset_path)
         feedback.pushDebugInfo(f"{len(dataset)}")
 
         # -----------------------------
@@ -244,12 +468,20 @@ class TrainModelAlgorithm(QgsProcessingAlgorithm):
         model = AutoModelForSemanticSegmentation.from_pretrained(p_checkpoint)
         processor = AutoImageProcessor.from_pretrained(p_checkpoint)
 
+        # processor parameters, read once for batched preprocessing on the device
+        preprocessor = preprocessing.Preprocessor.from_processor(processor)
+        feedback.pushDebugInfo(f"{preprocessor}")
+
+        if params.get("CACHE_PREPROCESSED", False):
+            self.cache_preprocessed(dataset, preprocessor, params, feedback)
+
         # -----------------------------
         feedback.pushInfo("Training")
 
         self.train_fn(
             model=model,
             processor=processor,
+            preprocessor=preprocessor,
             dataset=dataset,
             params=params,
             feedback=feedback,
@@ -2,19 +2,50 @@ from transformers import SamModel, SamProcessor, SamConfig
 import torch
 import numpy as np
 
-from . import utils
+from . import utils, masks
+
+
+def _bilinear_axis(in_size: int, out_size: int, start: int, stop: int) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Source indices and weights of the output pixels [start, stop) along an axis
+    of a bilinear resize, as `F.interpolate(..., align_corners=False)` takes them"""
+
+    src = ((torch.arange(start, stop, dtype=torch.float32) + .5) * (in_size / out_size) - .5).clamp(min=0)
+
+    i0 = src.long().clamp(max=in_size - 1)
+    i1 = (i0 + 1).clamp(max=in_size - 1)
+
+    return i0, i1, src - i0
+
+
+def _resize_window(
+    x: torch.Tensor,
+    in_size: tuple[int, int],
+    out_size: tuple[int, int],
+    rows: tuple[int, int],
+    cols: tuple[int, int],
+    offset: tuple[int, int] = (0, 0)
+) -> torch.Tensor:
+    """Window `rows` x `cols` of the bilinear resize of a (..., *in_size) input to `out_size`
+
+    `x` is the part of the input at `offset` (row, col) holding the pixels the window needs"""
+
+    r0, r1, rw = _bilinear_axis(in_size[0], out_size[0], *rows)
+    c0, c1, cw = _bilinear_axis(in_size[1], out_size[1], *cols)
+
+    x = x[..., r0 - offset[0], :] * (1 - rw)[:, None] + x[..., r1 - offset[0], :] * rw[:, None]
+    return x[..., c0 - offset[1]] * (1 - cw) + x[..., c1 - offset[1]] * cw
 
 
 class SAM:
     # NOTE: do not change default values to the parameters
     def __init__(self, checkpoint: str = "facebook/sam-vit-large", device="cpu"):
         #
+        self.checkpoint = None
+
         self.set_checkpoint(checkpoint)
         self.set_device(device)
 
         #
-        self.checkpoint = None
-
         self.__image_context: utils.ImageContext = None
 
         self.__image_embedding = None
@@ -48,16 +79,41 @@ class SAM:
         self.device = torch.device(device)
         self.m.to(device)
 
-    def set_image(self, image_context: utils.ImageContext):
+    def embed(self, image_context: utils.ImageContext, cache_key: str = None) -> torch.Tensor:
+        """Image embedding of the context, read from / written to the cache with `cache_key`"""
+
+        cache_file = None
+
+        if cache_key is not None:
+            cache_file = utils.embedding_cache_file(cache_key)
+
+            if cache_file.exists():
+                # recently used, kept by the cache pruning
+                cache_file.touch()
+                return torch.load(cache_file, map_location=self.m.device)
+
         inp = self.p(
             images=image_context.image,
             return_tensors="pt"
         ).to(device=self.m.device)
 
         with torch.no_grad():
-            self.__image_embedding = self.m.get_image_embeddings(
+            embedding = self.m.get_image_embeddings(
                 pixel_values=inp["pixel_values"])
 
+        if cache_file is not None:
+            cache_file.parent.mkdir(exist_ok=True, parents=True)
+
+            # a partly written file is never taken for a cached embedding
+            torch.save(embedding.cpu(), cache_file.with_suffix(".tmp"))
+            cache_file.with_suffix(".tmp").replace(cache_file)
+
+            utils.prune_embedding_cache()
+
+        return embedding
+
+    def set_image(self, image_context: utils.ImageContext, cache_key: str = None):
+        self.__image_embedding = self.embed(image_context, cache_key=cache_key)
         self.__image_context = image_context
         return True
 
@@ -107,17 +163,62 @@ class SAM:
                 multimask_output=True # NOTE
             )
 
-        rimg, *_ = self.p.post_process_masks(
-            out.pred_masks.cpu(),
-            inp["original_sizes"].cpu(),
-            inp["reshaped_input_sizes"].cpu())
+        return self.__post_process_window(
+            out.pred_masks[0, 0].cpu(),
+            inp["original_sizes"][0].tolist(),
+            inp["reshaped_input_sizes"][0].tolist())
+
+    def __post_process_window(
+        self,
+        logits: torch.Tensor,
+        original_size: tuple[int, int],
+        reshaped_size: tuple[int, int]
+    ) -> tuple[np.ndarray, tuple[int, int]]:
+        """Union of the (M, h, w) low resolution mask logits at the image's size,
+        as `post_process_masks` computes it but only over the masks' window
+
+        Returns the window's mask and its (col, row) offset, (None, None) when empty"""
+
+        hit = (logits > 0).any(dim=0)
 
-        rimg = rimg.to(torch.uint8)[0] \
-            .any(axis=0) \
-            .numpy() \
-            .astype(np.uint8)
+        if not hit.any():
+            return None, None
 
-        return rimg
+        low = tuple(logits.shape[-2:])
+        pad = self.p.image_processor.pad_size
+        pad = (pad["height"], pad["width"])
+
+        window = []
+        for axis in (0, 1):
+            idx = torch.nonzero(hit.any(dim=1 - axis)).flatten()
+
+            # interpolation spreads positive logits by less than a source pixel
+            scale = pad[axis] / low[axis]
+            p0, p1 = (int(idx[0]) - 1) * scale, (int(idx[-1]) + 2) * scale
+
+            # padded input frame -> image frame, of which the input is the top-left `reshaped_size`
+            scale = original_size[axis] / reshaped_size[axis]
+            window.append((
+                max(int(np.floor((p0 - 1) * scale)) - 1, 0),
+                min(int(np.ceil((p1 + 1) * scale)) + 1, original_size[axis]), ))
+
+        rows, cols = window
+
+        # positive only in the padding
+        if rows[0] >= rows[1] or cols[0] >= cols[1]:
+            return None, None
+
+        # upsampled (padded) frame window the image window samples, then the image window
+        r0, r1, _ = _bilinear_axis(reshaped_size[0], original_size[0], *rows)
+        c0, c1, _ = _bilinear_axis(reshaped_size[1], original_size[1], *cols)
+
+        offset = (int(r0.min()), int(c0.min()))
+
+        x = _resize_window(logits, low, pad, (offset[0], int(r1.max()) + 1), (offset[1], int(c1.max()) + 1))
+        x = _resize_window(x, reshaped_size, original_size, rows, cols, offset=offset)
+
+        mask = (x > 0).any(dim=0).numpy().astype(np.uint8)
+        return mask, (cols[0], rows[0])
 
 
 from qgis.core import (
@@ -136,6 +237,11 @@ from PyQt5.QtWidgets import QInputDialog
 import rasterio
 
 class SAMBridgeForQGIS(SAM):
+    def __init__(self, *args, **kw):
+        super().__init__(*args, **kw)
+
+        self.cleanup = masks.MaskCleanup()
+
     def qgs_prompt_points(
         self,
         pts: list[list[QgsReferencedPointXY, int]],
@@ -143,46 +249,39 @@ class SAMBridgeForQGIS(SAM):
     ) -> list[QgsGeometry]:
         """Prompt SAM with point prompts and return the shapes"""
 
-        trf = QgsCoordinateTransform(
-            pts[0][0].crs(), self.context.bbox.crs(), QgsProject.instance())
+        mask, bounds = self.qgs_prompt_points_mask(pts, to_crs)
 
-        for i, (p, l) in enumerate(pts):
-            p = trf.transform(p)
+        if mask is None:
+            return []
 
-            p = self.context.resolve(
-                p.x() - self.context.bbox.xMinimum(),
-                self.context.bbox.yMaximum() - p.y() )
+        return masks.vectorize(mask, transform=bounds, cleanup=self.cleanup)
 
-            pts[i] = [p, l]
+    def qgs_prompt_points_mask(
+        self,
+        pts: list[list[QgsReferencedPointXY, int]],
+        to_crs: QgsCoordinateReferenceSystem
+    ) -> tuple[np.ndarray, rasterio.Affine]:
+        """Prompt SAM with point prompts and return the mask and its transform in `to_crs`"""
 
-        mask = self.prompt(pts)
+        trf = utils.coordinate_transform(pts[0][0].crs(), self.context.bbox.crs())
 
-        if mask is None:
-            return []
+        xy = np.array([[p.x(), p.y()] for p, _ in pts], dtype=np.float64)
 
-        p_bbox = self.context.to_crs(to_crs)
+        if not trf.isShortCircuited():
+            # all the points in one call, the geometry's coordinates are transformed as arrays
+            geom = QgsGeometry.fromMultiPointXY([QgsPointXY(p) for p, _ in pts])
+            geom.transform(trf)
 
-        bounds = rasterio.transform.from_bounds(
-            p_bbox.xMinimum(), p_bbox.yMinimum(),
-            p_bbox.xMaximum(), p_bbox.yMaximum(),
-            self.image_width, self.image_height, )
+            xy = np.array([[q.x(), q.y()] for q in geom.asMultiPoint()], dtype=np.float64)
 
-        polygons = rasterio.features.shapes(
-            source=mask,
-            mask=mask,
-            connectivity=4,
-            transform=bounds, )
+        xy = self.context.internal_points(xy)
 
-        shapes = []
-        for p, v in polygons:
-            if v == 0:
-                continue
+        mask = self.prompt([[p, l] for p, (_, l) in zip(xy.tolist(), pts)])
 
-            points = [QgsPointXY(x, y) for x, y in p["coordinates"][0]]
-            geom = QgsGeometry.fromPolygonXY([points])
+        if mask is None:
+            return None, None
 
-            shapes.append(geom)
-        return shapes
+        return mask, self.context.pixel_transform(to_crs)
 
     def qgs_prompt_bbox(
         self,
@@ -191,37 +290,29 @@ class SAMBridgeForQGIS(SAM):
     ) -> list[QgsGeometry]:
         """Prompt SAM with a bbox prompt and return the shapes"""
 
-        bbox = QgsCoordinateTransform(bbox.crs(), self.context.bbox.crs(), QgsProject.instance()) \
-            .transformBoundingBox(bbox)
-
-        box: list[float] = self.context.internal_box(bbox)
-
-        mask = self.prompt_box(box)
+        mask, bounds = self.qgs_prompt_bbox_mask(bbox, to_crs)
 
         if mask is None:
             return
 
-        # project the mask to the vector layer's CRS
-        v_bbox = self.context.to_crs(to_crs)
+        return masks.vectorize(mask, transform=bounds, cleanup=self.cleanup)
 
-        bounds = rasterio.transform.from_bounds(
-            v_bbox.xMinimum(), v_bbox.yMinimum(),
-            v_bbox.xMaximum(), v_bbox.yMaximum(),
-            self.image_width, self.image_height, )
+    def qgs_prompt_bbox_mask(
+        self,
+        bbox: QgsReferencedRectangle,
+        to_crs: QgsCoordinateReferenceSystem
+    ) -> tuple[np.ndarray, rasterio.Affine]:
+        """Prompt SAM with a bbox prompt and return the mask and its transform in `to_crs`"""
 
-        polygons = rasterio.features.shapes(
-            source=mask,
-            mask=mask,
-            connectivity=4,
-            transform=bounds, )
+        bbox = utils.coordinate_transform(bbox.crs(), self.context.bbox.crs()) \
+            .transformBoundingBox(bbox)
 
-        shapes = []
-        for p, v in polygons:
-            if v == 0:
-                continue
+        box: list[float] = self.context.internal_box(bbox)
+
+        mask, offset = self.prompt_box(box)
 
-            pts = [QgsPointXY(x, y) for x, y in p["coordinates"][0]]
-            geom = QgsGeometry.fromPolygonXY([pts])
+        if mask is None:
+            return None, None
 
-            shapes.append(geom)
-        return shapes
+        # project the mask window to the vector layer's CRS
+        return mask, self.context.pixel_transform(to_crs) * rasterio.Affine.translation(*offset)
@@ -5,6 +5,7 @@ import torch
 
 import rasterio
 import numpy as np
+import time
 import os
 
 from .sam import SAM
@@ -16,15 +17,21 @@ class SamImageEmbedTask(QgsTask):
         self,
         sam: SAM,
         context: utils.ImageContext,
-        description: str = None
+        cache_key: str = None,
+        description: str = None,
+        callback = None
     ):
         super().__init__(description=description, flags=QgsTask.CanCancel)
 
         self.sam = sam
         self.context = context
+        self.cache_key = cache_key
+
+        # called with the cache key once the embedding is set
+        self.callback = callback
 
     def run(self):
-        self.sam.set_image(image_context=self.context)
+        self.sam.set_image(image_context=self.context, cache_key=self.cache_key)
         return True
 
     def finished(self, exception, res=None):
@@ -36,6 +43,12 @@ class SamImageEmbedTask(QgsTask):
 
             raise exception
 
+        if not res:
+            return
+
+        if self.callback is not None:
+            self.callback(self.cache_key)
+
         QgsMessageLog.logMessage(
             f"Embed complete {{bbox: {self.sam.bbox.toString()}}}",
             "QSAM",
@@ -143,3 +156,133 @@ class InferenceTask(QgsTask):
             f"Embed complete {{bbox: {self.sam.bbox.toString()}}}",
             "QSAM",
             Qgis.Info)
+
+
+class FeatureFlushTask(QgsTask):
+    """Write buffered features through an independent provider, off the GUI thread"""
+
+    def __init__(
+        self,
+        layer: QgsVectorLayer,
+        features: list[QgsFeature],
+        fids: list[int] = None,
+        description: str = None,
+        callback = None
+    ):
+        super().__init__(description=description, flags=QgsTask.Silent)
+
+        self.source = layer.source()
+        self.provider_type = layer.providerType()
+        self.features = features
+        self.fids = fids or []
+
+        self.written: list[QgsFeature] = []
+        self.latency: float = None
+
+        # outcome, also when run raised
+        self.ok = False
+        self.deleted = False
+
+        self.callback = callback
+
+    def run(self):
+        time_start = time.perf_counter()
+
+        layer = QgsVectorLayer(self.source, "QSAM flush", self.provider_type)
+
+        if self.fids:
+            if not layer.dataProvider().deleteFeatures(self.fids):
+                return False
+            self.deleted = True
+
+        self.ok, self.written = layer.dataProvider().addFeatures(self.features)
+
+        self.latency = time.perf_counter() - time_start
+        return self.ok
+
+    def finished(self, exception, res=None):
+        if self.callback is not None:
+            self.callback(self)
+
+        if exception is not None:
+            QgsMessageLog.logMessage(
+                "Exception: {}".format(exception),
+                "QSAM",
+                Qgis.Critical)
+
+            raise exception
+
+        if not res:
+            QgsMessageLog.logMessage(
+                f"Flush failed {{source: {self.source}, features: {len(self.features)}}}",
+                "QSAM",
+                Qgis.Critical)
+
+
+class SamBatchEmbedTask(QgsTask):
+    """Embed and cache a batch of ROIs of a raster with a dedicated SAM instance"""
+
+    def __init__(
+        self,
+        checkpoint: str,
+        raster_source: str,
+        raster_provider: str,
+        roi_ids: list[int],
+        db_path: str,
+        resolution: float = 1000.,
+        description: str = None
+    ):
+        super().__init__(description=description, flags=QgsTask.CanCancel)
+
+        self.checkpoint = checkpoint
+        self.raster_source = raster_source
+        self.raster_provider = raster_provider
+        self.roi_ids = roi_ids
+        self.db_path = db_path
+        self.resolution = resolution
+
+        self.embedded = 0
+
+    def run(self):
+        from .data import DataStore
+
+        sam = SAM(checkpoint=self.checkpoint)
+        db = DataStore(self.db_path)
+
+        layer = QgsRasterLayer(self.raster_source, "QSAM batch embed", self.raster_provider)
+
+        for i, roi_id in enumerate(self.roi_ids):
+            if self.isCanceled():
+                break
+
+            record = db.get_record(roi_id)
+
+            if record is None:
+                continue
+
+            context = utils.image_from_layer(layer=layer, bbox=record.rect, resolution=self.resolution)
+            key = utils.embedding_key(
+                layer=layer, bbox=record.rect, resolution=self.resolution, checkpoint=sam.checkpoint)
+
+            sam.embed(context, cache_key=key)
+            db.set_embedding_key(roi_id, key, checkpoint=sam.checkpoint)
+
+            self.embedded += 1
+            self.setProgress(100 * (i + 1) / len(self.roi_ids))
+
+        db.close()
+        return True
+
+    def finished(self, exception, res=None):
+        if exception is not None:
+            QgsMessageLog.logMessage(
+                "Exception: {}".format(exception),
+                "QSAM",
+                Qgis.Critical)
+
+            raise exception
+
+        QgsMessageLog.logMessage(
+            f"Batch embed complete {{rois: {self.embedded}/{len(self.roi_ids)}}}",
+            "QSAM",
+            Qgis.Info)
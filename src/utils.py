@@ -8,21 +8,73 @@ from qgis.core import (
     QgsFeature,
     QgsReferencedRectangle,
     QgsMapLayerStyleManager,
+    QgsFillSymbol,
+    QgsGeometry,
     QgsCoordinateReferenceSystem )
 
 from qgis.PyQt.QtCore import QStandardPaths
 from qgis.gui import QgsMapCanvas, QgsMessageBar
 
-from rasterio.transform import from_bounds
+from rasterio.transform import from_bounds, Affine
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from functools import cached_property
 from pathlib import Path
 import numpy as np
+import hashlib
 import os
 
 from . import consts
 
 
+def crs_key(crs: QgsCoordinateReferenceSystem) -> str:
+    return crs.authid() or crs.toWkt()
+
+
+class TransformCache:
+    """QgsCoordinateTransform objects keyed by (source CRS, destination CRS)
+
+    Entries are bound to the project's transform context and dropped
+    whenever it changes"""
+
+    def __init__(self):
+        self.transforms: dict[tuple[str, str], QgsCoordinateTransform] = {}
+        self.project = None
+
+    def clear(self):
+        self.transforms.clear()
+
+    def get(
+        self,
+        src: QgsCoordinateReferenceSystem,
+        dst: QgsCoordinateReferenceSystem
+    ) -> QgsCoordinateTransform:
+
+        proj = QgsProject.instance()
+
+        if self.project is not proj:
+            self.clear()
+            proj.transformContextChanged.connect(self.clear)
+
+            self.project = proj
+
+        key = (crs_key(src), crs_key(dst))
+
+        if key not in self.transforms:
+            self.transforms[key] = QgsCoordinateTransform(src, dst, proj)
+        return self.transforms[key]
+
+
+transforms = TransformCache()
+
+
+def coordinate_transform(
+    src: QgsCoordinateReferenceSystem,
+    dst: QgsCoordinateReferenceSystem
+) -> QgsCoordinateTransform:
+    return transforms.get(src, dst)
+
+
 @dataclass
 class ImageContext:
     image: np.ndarray
@@ -31,6 +83,39 @@ class ImageContext:
     scale: list[float]
     resolution: float
 
+    _bboxes: dict = field(default_factory=dict, init=False, repr=False)
+
+    @cached_property
+    def map_to_pixel(self) -> Affine:
+        """Affine from the layer CRS to the (resolved) image pixels"""
+
+        sx = self.resolution / self.scale[0]
+        sy = self.resolution / self.scale[1]
+
+        return Affine(
+            sx, 0, -self.bbox.xMinimum() * sx,
+            0, -sy, self.bbox.yMaximum() * sy)
+
+    def internal_points(self, xy: np.ndarray) -> np.ndarray:
+        """Map (N, 2) layer CRS coordinates to image pixels"""
+
+        t = self.map_to_pixel
+        xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+
+        return np.stack([
+            t.a * xy[:, 0] + t.c,
+            t.e * xy[:, 1] + t.f], axis=1)
+
+    def pixel_transform(self, crs: QgsCoordinateReferenceSystem) -> Affine:
+        """Affine from the image pixels to the bbox of this context in `crs`"""
+
+        r = self.to_crs(crs)
+
+        return from_bounds(
+            r.xMinimum(), r.yMinimum(),
+            r.xMaximum(), r.yMaximum(),
+            self.image.shape[1], self.image.shape[0])
+
     def resolve(self, x: float, y: float) -> list[int, int]:
         return [
             x / self.scale[0] * self.resolution,
@@ -58,15 +143,50 @@ class ImageContext:
         return list(self.resolve_bbox(bbox).toRectF().getCoords())
 
     def to_crs(self, crs: QgsCoordinateReferenceSystem) -> QgsReferencedRectangle:
-        proj = QgsProject.instance()
-
         if crs == "proj":
-            crs = proj.crs()
+            crs = QgsProject.instance().crs()
+
+        key = crs_key(crs)
+
+        if key not in self._bboxes:
+            r = coordinate_transform(self.bbox.crs(), crs) \
+                .transformBoundingBox(self.bbox)
+
+            self._bboxes[key] = QgsReferencedRectangle(rectangle=r, crs=crs)
+        return self._bboxes[key]
+
+
+class RenderCounter:
+    """Counts canvas renders per interaction, full-map refreshes show up as renders"""
+
+    def __init__(self):
+        self.renders = 0
+        self.interactions = 0
+
+        self.__last_renders = 0
+
+    def __on_render(self):
+        self.renders += 1
+
+    def attach(self, canvas: QgsMapCanvas):
+        canvas.renderStarting.connect(self.__on_render)
+
+    def detach(self, canvas: QgsMapCanvas):
+        canvas.renderStarting.disconnect(self.__on_render)
+
+    def interaction(self, name: str):
+        if consts.MODE_DEBUG:
+            log(f"{name} {{renders since last interaction: {self.renders - self.__last_renders}}}")
+
+        self.interactions += 1
+        self.__last_renders = self.renders
+
+    @property
+    def renders_per_interaction(self) -> float:
+        return self.renders / max(self.interactions, 1)
 
-        r = QgsCoordinateTransform(self.bbox.crs(), crs, proj) \
-            .transformBoundingBox(self.bbox)
 
-        return QgsReferencedRectangle(rectangle=r, crs=crs)
+render_counter = RenderCounter()
 
 
 def log(*args, banner=False):
@@ -89,9 +209,7 @@ def image_from_layer(
     resolution: float = 1000.
 ) -> ImageContext:
 
-    proj = QgsProject.instance()
-
-    l_bbox = QgsCoordinateTransform(bbox.crs(), layer.crs(), proj) \
+    l_bbox = coordinate_transform(bbox.crs(), layer.crs()) \
         .transformBoundingBox(bbox)
     l_bbox = QgsReferencedRectangle(rectangle=l_bbox, crs=layer.crs())
 
@@ -157,18 +275,44 @@ def empty_vector_layer(
     return layer
 
 
-def write_features_into_vector_layer(
-    features: list[QgsFeature],
-    layer: QgsVectorLayer,
-    canvas: QgsMapCanvas
-):
-    layer.startEditing()
-    layer.dataProvider().addFeatures(features)
+def roi_vector_layer(
+    p_crs: QgsCoordinateReferenceSystem = None
+) -> QgsVectorLayer:
 
-    layer.commitChanges(stopEditing=True)
-    canvas.refresh()
+    if p_crs is None:
+        p_crs = QgsProject.instance().crs()
 
-    return True
+    layer = QgsVectorLayer(
+        path=f"Polygon?crs={p_crs.authid()}&field=id:integer"
+            "&field=annotations:integer&index=yes",
+        baseName="QSAM ROIs",
+        providerLib="memory", )
+
+    layer.renderer().setSymbol(QgsFillSymbol.createSimple({
+        "color": "0,0,0,0",
+        "outline_color": "0,255,0,255",
+        "outline_width": "0.8", }))
+
+    return layer
+
+
+def roi_features(
+    records: list,
+    layer: QgsVectorLayer
+) -> list[QgsFeature]:
+    """Features of ROI records (data.RoiRecord) in the CRS of `layer`"""
+
+    features = []
+    for r in records:
+        geom = QgsGeometry.fromRect(r.rect)
+        geom.transform(coordinate_transform(r.rect.crs(), layer.crs()))
+
+        ft = QgsFeature(layer.fields())
+        ft.setGeometry(geom)
+        ft.setAttributes([r.id, r.annotation_count])
+
+        features.append(ft)
+    return features
 
 
 def transform_from_qgs_refrect(bbox, arr_shape):
@@ -182,16 +326,6 @@ def transform_from_qgs_refrect(bbox, arr_shape):
     return transform
 
 
-def normalize(a: np.ndarray):
-    """a is np.ndarray in shape (C, H, W)"""
-
-    a = a.astype(float)
-
-    for i in range(a.shape[0]):
-        a[i] = (a[i] - a[i].min()) / (a[i].max() - a[i].min())
-    return a.astype(np.float32)
-
-
 def get_db_path():
     db_path = QgsProject.instance().fileName()
 
@@ -228,6 +362,62 @@ def get_model_write_path() -> Path:
     return Path(os.path.join(ds_path, "qsam", "models"))
 
 
+def get_embedding_cache_path() -> Path:
+    ds_path = QgsProject.instance().fileName()
+
+    if not os.path.exists(ds_path):
+        ds_path = QStandardPaths.writableLocation(QStandardPaths.TempLocation)
+
+    elif os.path.isfile(ds_path):
+        ds_path = os.path.dirname(ds_path)
+
+    return Path(os.path.join(ds_path, "qsam", "embeddings"))
+
+
+def embedding_cache_file(key: str) -> Path:
+    return get_embedding_cache_path() / f"{key}.pt"
+
+
+def prune_embedding_cache(max_bytes: int = consts.EMBEDDING_CACHE_MAX_MB * 2 ** 20) -> list[str]:
+    """Delete the least recently used embeddings beyond `max_bytes`, returns their keys"""
+
+    files = []
+    for path in get_embedding_cache_path().glob("*.pt"):
+        try:
+            st = path.stat()
+        except OSError:
+            continue
+        files.append((st.st_mtime, st.st_size, path))
+
+    total, removed = 0, []
+    for _, size, path in sorted(files, key=lambda f: f[0], reverse=True):
+        total += size
+
+        if total > max_bytes:
+            path.unlink(missing_ok=True)
+            removed.append(path.stem)
+
+    if removed:
+        log(f"Embeddings cache pruned {{removed: {len(removed)}, max_bytes: {max_bytes}}}")
+    return removed
+
+
+def embedding_key(
+    layer: QgsRasterLayer,
+    bbox: QgsReferencedRectangle,
+    resolution: float,
+    checkpoint: str
+) -> str:
+    """Key of the SAM embedding for an ROI of `layer`"""
+
+    return hashlib.sha1("|".join([
+        layer.source(),
+        f"{bbox.xMinimum():.8f},{bbox.yMinimum():.8f},{bbox.xMaximum():.8f},{bbox.yMaximum():.8f}",
+        crs_key(bbox.crs()),
+        str(resolution),
+        str(checkpoint)]).encode()).hexdigest()
+
+
 def extent_str_from_rectangle(rt: QgsReferencedRectangle) -> str:
     return f"{rt.xMinimum():.8f},{rt.xMaximum():.8f},{rt.yMinimum():.8f},{rt.yMaximum():.8f} [EPSG:{rt.crs().postgisSrid()}]"
 
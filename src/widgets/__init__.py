@@ -1,2 +1,3 @@
 from .toolbar import *
 from .panel import *
+from .preview import *
@@ -26,6 +26,7 @@ import torch
 import os
 
 from .toolbar import BBoxTool
+from ..overlap import OverlapPolicy
 from .. import utils
 
 
@@ -143,6 +144,8 @@ class SamWidget(QGroupBox):
     selected_checkpoint = pyqtSignal(str)
     streaming_enabled = pyqtSignal(bool)
     resolution_set = pyqtSignal(int)
+    cleanup_set = pyqtSignal(str, float)
+    overlap_policy_set = pyqtSignal(str)
 
     def __init__(self, parent):
         super().__init__(title="SAM", parent=parent)
@@ -199,6 +202,33 @@ class SamWidget(QGroupBox):
         self.m_resolution.enterEvent = lambda e: self.m_resolution.setToolTip("Resolution of the image")
         self.m_resolution.valueChanged.connect(lambda v: self.resolution_set.emit(v))
 
+        # mask cleanup
+        self.m_min_area = QSpinBox()
+        self.m_min_area.setRange(0, 100000)
+        self.m_min_area.setValue(16)
+        self.m_min_area.setToolTip("Drop components smaller than this (px)")
+        self.m_min_area.valueChanged.connect(lambda v: self.cleanup_set.emit("min_area", v))
+
+        self.m_max_hole = QSpinBox()
+        self.m_max_hole.setRange(0, 100000)
+        self.m_max_hole.setValue(16)
+        self.m_max_hole.setToolTip("Fill holes smaller than this (px)")
+        self.m_max_hole.valueChanged.connect(lambda v: self.cleanup_set.emit("max_hole", v))
+
+        self.m_simplify = QDoubleSpinBox()
+        self.m_simplify.setRange(0., 100.)
+        self.m_simplify.setSingleStep(.25)
+        self.m_simplify.setValue(.5)
+        self.m_simplify.setToolTip("Simplification tolerance (px)")
+        self.m_simplify.valueChanged.connect(lambda v: self.cleanup_set.emit("simplify", v))
+
+        # overlap policy
+        self.m_overlap = QComboBox()
+        self.m_overlap.addItems(OverlapPolicy.all)
+        self.m_overlap.setCurrentText(OverlapPolicy.none)
+        self.m_overlap.setToolTip("Overlap with existing polygons")
+        self.m_overlap.currentTextChanged.connect(self.overlap_policy_set.emit)
+
         # streaming
         self.stream = QCheckBox(text="Streaming Enabled")
         self.stream.setChecked(True)
@@ -223,6 +253,17 @@ class SamWidget(QGroupBox):
     def __layout_row_3(self):
         l = QHBoxLayout()
         l.addWidget(self.stream, stretch=1)
+        l.addWidget(QLabel(text="Overlap"))
+        l.addWidget(self.m_overlap)
+
+        return l
+
+    def __layout_row_4(self):
+        l = QHBoxLayout()
+        l.addWidget(QLabel(text="Cleanup"))
+        l.addWidget(self.m_min_area)
+        l.addWidget(self.m_max_hole)
+        l.addWidget(self.m_simplify)
 
         return l
 
@@ -232,6 +273,7 @@ class SamWidget(QGroupBox):
         l_m = QVBoxLayout(self)
         l_m.addLayout(self.__layout_row_1())
         l_m.addLayout(self.__layout_row_2())
+        l_m.addLayout(self.__layout_row_4())
         l_m.addLayout(self.__layout_row_3())
 
         self.setLayout(l_m)
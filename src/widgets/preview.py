@@ -0,0 +1,70 @@
+from qgis.gui import QgsMapCanvas, QgsMapCanvasItem
+from qgis.core import QgsRectangle
+
+from PyQt5.QtGui import QImage, QColor, QPainter
+
+from rasterio.transform import Affine
+import numpy as np
+
+from .. import masks
+
+
+__all__ = ["MaskPreview"]
+
+
+class MaskPreview(QgsMapCanvasItem):
+    """Georeferenced, semi-transparent mask bitmap drawn over the canvas
+
+    Updating the mask only repaints this item's region, the map layers are
+    not re-rendered"""
+
+    def __init__(self, canvas: QgsMapCanvas, color: QColor = QColor(0, 0, 0, 100)):
+        super().__init__(canvas)
+
+        self.image: QImage = None
+        self.__buffer: np.ndarray = None
+
+        self.set_color(color)
+        self.setZValue(10)
+
+    def set_color(self, color: QColor):
+        # premultiplied ARGB32
+        a = color.alpha() / 255
+        self.__pixel = np.uint32(
+            (color.alpha() << 24)
+            | (int(color.red() * a) << 16)
+            | (int(color.green() * a) << 8)
+            | int(color.blue() * a))
+
+    def set_mask(self, mask: np.ndarray, transform: Affine):
+        """Show `mask`, whose pixels map to canvas CRS coordinates via `transform`"""
+
+        mask, transform = masks.crop(mask, transform, pad=0)
+
+        if mask is None:
+            return self.reset()
+
+        h, w = mask.shape
+
+        self.__buffer = np.where(mask > 0, self.__pixel, np.uint32(0)).astype(np.uint32)
+        self.image = QImage(self.__buffer.data, w, h, 4 * w, QImage.Format_ARGB32_Premultiplied)
+
+        x0, y0 = transform * (0, 0)
+        x1, y1 = transform * (w, h)
+
+        self.setRect(QgsRectangle(x0, y0, x1, y1))
+        self.show()
+        self.update()
+
+    def reset(self):
+        self.image = None
+        self.__buffer = None
+
+        self.hide()
+        self.update()
+
+    def paint(self, painter: QPainter, option=None, widget=None):
+        if self.image is None:
+            return
+
+        painter.drawImage(self.boundingRect(), self.image)
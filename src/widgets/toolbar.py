@@ -21,6 +21,8 @@ from PyQt5.QtWidgets import QMessageBox
 from PyQt5.QtCore import Qt, pyqtSignal
 from PyQt5.QtGui import QColor
 
+from .. import utils
+
 
 __all__ = ["QSamToolBar"]
 
@@ -45,7 +47,6 @@ class BBoxTool(QgsMapTool):
 
     def _clear_rect(self):
         self._rb.reset()
-        self.canvas().refresh()
 
     def __init__(self, canvas: QgsMapCanvas):
         super().__init__(canvas)
@@ -60,8 +61,6 @@ class BBoxTool(QgsMapTool):
 
     def activate(self):
         self.canvas().setMapTool(self)
-        self.canvas().refresh()
-
         return super().activate()
 
     def deactivate(self):
@@ -71,6 +70,8 @@ class BBoxTool(QgsMapTool):
         return super().deactivate()
 
     def canvasPressEvent(self, e: QgsMapMouseEvent):
+        utils.render_counter.interaction("BBoxTool.press")
+
         if e.button() == Qt.LeftButton:
             self.x1y1 = self.toMapCoordinates(e.pos())
             self.x2y2 = None
@@ -104,7 +105,6 @@ class BBoxTool(QgsMapTool):
             self.approve_click.emit(self.__prev_bbox)
             self.__prev_bbox = None
 
-        self.canvas().refresh()
         return super().canvasPressEvent(e)
 
     def canvasMoveEvent(self, e: QgsMapMouseEvent):
@@ -133,7 +133,6 @@ class PointTool(QgsMapTool):
         mrk.setIconType(QgsVertexMarker.ICON_CIRCLE)
         mrk.setPenWidth(3)
 
-        self.canvas().refresh()
         self.points.append([point, label, mrk])
 
     def _clear_markers(self):
@@ -141,7 +140,6 @@ class PointTool(QgsMapTool):
         for _, _, m in self.points:
             scene.removeItem(m)
 
-        self.canvas().refresh()
         self.points = []
 
     def __init__(self, canvas: QgsMapCanvas):
@@ -156,8 +154,6 @@ class PointTool(QgsMapTool):
 
     def activate(self):
         self.canvas().setMapTool(self)
-        self.canvas().refresh()
-
         return super().activate()
 
     def deactivate(self):
@@ -167,6 +163,8 @@ class PointTool(QgsMapTool):
         return super().deactivate()
 
     def canvasPressEvent(self, e: QgsMapMouseEvent):
+        utils.render_counter.interaction("PointTool.press")
+
         pt = self.toMapCoordinates(e.pos())
         pt = QgsReferencedPointXY(pt, crs=QgsProject.instance().crs())
 
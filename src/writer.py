@@ -0,0 +1,185 @@
+from qgis.core import QgsApplication, QgsFeature, QgsProject, QgsVectorLayer
+
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
+
+import time
+
+from . import tasks, utils
+
+
+__all__ = ["FeatureWriter"]
+
+
+class FeatureWriter(QObject):
+    """Buffered writes of accepted SAM features into their target layers
+
+    Features are kept per layer and flushed in batches, once `max_features`
+    are pending, `max_delay` ms after the first pending feature or on
+    `flush_all`. A flush is a single provider `addFeatures` call (preceded
+    by `deleteFeatures` for queued deletions); file backed layers are
+    flushed in a background task"""
+
+    # layer id, pending features, written features (with their ids)
+    flushed = pyqtSignal(str, list, list)
+
+    def __init__(
+        self,
+        max_features: int = 50,
+        max_delay: int = 2000,
+        max_wait: int = 30000,
+        parent: QObject = None
+    ):
+        super().__init__(parent)
+
+        self.max_features = max_features
+        self.max_delay = max_delay
+        self.max_wait = max_wait  # ms a synchronous flush waits for the layer's background flush
+
+        self.buffers: dict[str, list[QgsFeature]] = {}
+        self.deletions: dict[str, set[int]] = {}
+        self.__tasks: dict[str, tasks.FeatureFlushTask] = {}
+
+        self.__timer = QTimer(self)
+        self.__timer.setSingleShot(True)
+        self.__timer.timeout.connect(self.flush_all)
+
+    def pending(self, layer: QgsVectorLayer) -> list[QgsFeature]:
+        return self.buffers.get(layer.id(), [])
+
+    def discard(self, layer: QgsVectorLayer, feature: QgsFeature) -> bool:
+        """Drop a pending feature, False if it is not pending (anymore)"""
+
+        buffer = self.buffers.get(layer.id(), [])
+
+        for i, ft in enumerate(buffer):
+            if ft is feature:
+                del buffer[i]
+                return True
+        return False
+
+    def delete(self, layer: QgsVectorLayer, fids: list[int]):
+        """Queue the deletion of committed features with the next flush"""
+
+        self.deletions.setdefault(layer.id(), set()).update(fids)
+
+        if not self.__timer.isActive():
+            self.__timer.start(self.max_delay)
+
+    def add(self, layer: QgsVectorLayer, features: list[QgsFeature]):
+        if not features:
+            return
+
+        buffer = self.buffers.setdefault(layer.id(), [])
+        buffer.extend(features)
+
+        if len(buffer) >= self.max_features:
+            self.flush(layer.id())
+
+        elif not self.__timer.isActive():
+            self.__timer.start(self.max_delay)
+
+    def flush_all(self, background: bool = True):
+        self.__timer.stop()
+
+        layer_ids = set(self.buffers) | set(self.deletions)
+
+        if not background:
+            # settle the flushes in flight too
+            layer_ids |= set(self.__tasks)
+
+        for layer_id in layer_ids:
+            self.flush(layer_id, background=background)
+
+    def flush(self, layer_id: str, background: bool = True):
+        layer: QgsVectorLayer = QgsProject.instance().mapLayer(layer_id)
+
+        if layer is None:
+            self.buffers.pop(layer_id, None)
+            self.deletions.pop(layer_id, None)
+            return
+
+        task = self.__tasks.get(layer_id)
+
+        if task is not None:
+            # one background flush per layer in flight, the rest waits for the next one
+            if background:
+                return
+
+            # never write the same file through two providers at once
+            if not task.waitForFinished(self.max_wait):
+                utils.log(f"Background flush still running, features kept pending {{layer: {layer_id}}}")
+                return
+
+            self.__on_task_finished(layer_id, task, resume=False)
+
+        features = self.buffers.pop(layer_id, [])
+        fids = list(self.deletions.pop(layer_id, []))
+
+        if not features and not fids:
+            return
+
+        if not background or layer.providerType() == "memory":
+            time_start = time.perf_counter()
+
+            if fids and not layer.dataProvider().deleteFeatures(fids):
+                self.__failed(layer_id, features, fids)
+                return
+
+            ok, written = layer.dataProvider().addFeatures(features)
+
+            if not ok:
+                self.__failed(layer_id, features, [])
+                return
+
+            self.__flushed(layer_id, features, written, time.perf_counter() - time_start)
+            return
+
+        task = tasks.FeatureFlushTask(
+            layer=layer,
+            features=features,
+            fids=fids,
+            description="QSAM Feature Flush",
+            callback=lambda t: self.__on_task_finished(layer_id, t))
+
+        self.__tasks[layer_id] = task
+        QgsApplication.instance().taskManager().addTask(task=task,)
+
+    def __on_task_finished(self, layer_id: str, task: tasks.FeatureFlushTask, resume: bool = True):
+        # already settled by a synchronous flush
+        if self.__tasks.get(layer_id) is not task:
+            return
+
+        del self.__tasks[layer_id]
+
+        if not task.ok:
+            self.__failed(layer_id, task.features, [] if task.deleted else task.fids)
+            return
+
+        self.__flushed(layer_id, task.features, task.written, task.latency)
+
+        if resume and (self.buffers.get(layer_id) or self.deletions.get(layer_id)):
+            self.flush(layer_id)
+
+    def __failed(self, layer_id: str, features: list, fids: list):
+        """Put the features of a failed flush back, they are retried with the next flush"""
+
+        utils.log(f"Flush failed, features kept pending {{layer: {layer_id}, features: {len(features)}}}")
+
+        self.buffers[layer_id] = features + self.buffers.get(layer_id, [])
+
+        if fids:
+            self.deletions.setdefault(layer_id, set()).update(fids)
+
+    def __flushed(self, layer_id: str, features: list, written: list, latency: float):
+        utils.log(f"Features flushed {{layer: {layer_id}, features: {len(written)}, latency: {latency or 0:.3f}s}}")
+
+        layer = QgsProject.instance().mapLayer(layer_id)
+
+        if layer is not None:
+            # written through another provider instance
+            if layer.providerType() != "memory":
+                layer.dataProvider().reloadData()
+
+            layer.triggerRepaint()
+
+        self.flushed.emit(layer_id, features, written)